@@ -0,0 +1,138 @@
+#
+# On-the-fly synthetic TDOA training data
+#
+# A clean source snippet is delayed towards every microphone of the training geometry with a
+# fractional delay applied in the frequency domain, for a random source position inside the room,
+# then noise and a random gain are added per microphone. Everything runs in the DataLoader workers,
+# so training needs no preprocessed windows on disk beyond the source material.
+#
+import numpy as np
+import torch
+from cls_data_generator import MIC_PAIRS, process_rank, worker_slot
+
+
+class SyntheticTDOADataset(torch.utils.data.IterableDataset):
+    """
+    Endless stream of synthetic (x1, x2, target) examples, cut into epochs of epoch_size items.
+
+    Examples are generated block_size sources at a time: one rfft per source, the delays of all
+    microphones applied as a single broadcast phase ramp and one batched irfft back. Every source
+    gives one example per microphone pair, the examples of a block are shuffled before being
+    yielded. Items match cls_data_generator.WindowDataset, so collate_windows applies.
+    """
+
+    def __init__(self, mic_locs, xyz_min, xyz_max, sig_len, fs, c, epoch_size, track_store=None, file_names=None,
+                 pairs=MIC_PAIRS, delay_offset=0, max_tau=None, snr_db=(5, 40), gain_db=(-6, 6),
+                 block_size=256, seed=0):
+        """
+        :param mic_locs: (3, nb_mics) microphone coordinates
+        :param xyz_min: lower corner of the box source positions are drawn from
+        :param xyz_max: upper corner of that box
+        :param epoch_size: number of examples per epoch, shared between the DataLoader workers and
+                           distributed processes
+        :param track_store: TrackStore the source snippets are cut from, white noise is used if None
+        :param file_names: groups of track_store to take sources from, all of them if None
+        :param delay_offset: added to the delays to form the targets
+        :param max_tau: delays are clipped to [-max_tau, max_tau] so that they stay valid classes
+        :param snr_db: range of the per-microphone signal to noise ratio
+        :param gain_db: range of the per-microphone gain
+        """
+        super().__init__()
+        self.mic_locs = np.asarray(mic_locs, dtype=np.float64)
+        self.xyz_min = np.asarray(xyz_min, dtype=np.float64)
+        self.xyz_max = np.asarray(xyz_max, dtype=np.float64)
+        self.sig_len = sig_len
+        self.fs = fs
+        self.c = c
+        self.epoch_size = epoch_size
+        self.track_store = track_store
+        if file_names is None:
+            file_names = track_store.groups if track_store is not None else []
+        self.file_names = list(file_names)
+        self.pairs = np.asarray(pairs)
+        self.delay_offset = delay_offset
+        self.max_tau = max_tau
+        self.snr_db = snr_db
+        self.gain_db = gain_db
+        self.block_size = block_size
+        self.seed = seed
+        self.epoch = 0
+        self.rank, self.world_size = process_rank()
+
+        # 最远的两个麦克风之间的最大延迟，信号前面多留这么长，循环移位不会绕回窗口里
+        mic_dist = np.linalg.norm(self.mic_locs.T[:, None, :] - self.mic_locs.T[None, :, :], axis=2)
+        self.margin = int(np.ceil(mic_dist.max() * fs / c)) + 1
+        self.src_len = sig_len + self.margin
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.epoch_size
+
+    def __iter__(self):
+        # persistent DataLoader workers keep their own copy of the dataset and never see set_epoch,
+        # so every pass also moves the epoch on by itself
+        epoch = self.epoch
+        self.epoch += 1
+        nb_items = self.epoch_size
+        rng = np.random.RandomState(self.seed + epoch)
+        slot, nb_slots = worker_slot(self.rank, self.world_size)
+        if nb_slots > 1:
+            # every worker produces its own share of the epoch from its own random stream
+            nb_items = self.epoch_size // nb_slots
+            if slot < self.epoch_size % nb_slots:
+                nb_items += 1
+            rng = np.random.RandomState(self.seed + epoch + 1000 * (slot + 1))
+
+        while nb_items > 0:
+            x1, x2, delays = self.generate(rng, self.block_size)
+            for i in rng.permutation(len(delays))[:nb_items]:
+                yield x1[i], x2[i], np.float32(delays[i] + self.delay_offset)
+            nb_items -= len(delays)
+
+    def generate(self, rng, nb_sources):
+        """
+        Synthesizes nb_sources sources, seen by every microphone pair
+
+        :return: x1, x2 as (nb_sources * nb_pairs, sig_len) float32 arrays and the delays in samples
+        """
+        source_loc = rng.uniform(self.xyz_min, self.xyz_max, size=(nb_sources, 3))
+        dist = np.sqrt(np.sum((self.mic_locs.T[None, :, :] - source_loc[:, None, :]) ** 2, axis=2))
+        # propagation delay of every microphone relative to the closest one, in samples
+        tau = (dist - dist.min(axis=1, keepdims=True)) * self.fs / self.c
+
+        source = self.sources(rng, nb_sources)
+        spectrum = np.fft.rfft(source, axis=-1)
+        freqs = np.arange(spectrum.shape[-1]) / self.src_len
+        shift = np.exp(-2j * np.pi * tau[:, :, None] * freqs[None, None, :])
+        mics = np.fft.irfft(spectrum[:, None, :] * shift, n=self.src_len, axis=-1)[:, :, self.margin:]
+
+        rms = np.sqrt(np.mean(mics ** 2, axis=-1, keepdims=True)) + 1e-8
+        snr = rng.uniform(self.snr_db[0], self.snr_db[1], size=rms.shape)
+        mics = mics + rng.standard_normal(mics.shape) * rms * 10 ** (-snr / 20)
+        mics = mics * 10 ** (rng.uniform(self.gain_db[0], self.gain_db[1], size=rms.shape) / 20)
+        mics = mics.astype(np.float32)
+
+        # 和 cls_data_generator.pair_delays 相同的方向：x1 离声源更远时 delay 为正
+        delays = (tau[:, self.pairs[:, 0]] - tau[:, self.pairs[:, 1]]).reshape(-1)
+        if self.max_tau is not None:
+            delays = np.clip(delays, -self.max_tau, self.max_tau)
+        x1 = mics[:, self.pairs[:, 0]].reshape(-1, self.sig_len)
+        x2 = mics[:, self.pairs[:, 1]].reshape(-1, self.sig_len)
+        return x1, x2, delays.astype(np.float32)
+
+    def sources(self, rng, nb_sources):
+        """
+        (nb_sources, src_len) clean source snippets: random channels of random recordings, or white noise
+        """
+        if not self.file_names:
+            return rng.standard_normal((nb_sources, self.src_len)) * 1000.0
+
+        source = np.empty((nb_sources, self.src_len))
+        for i, file_idx in enumerate(rng.randint(len(self.file_names), size=nb_sources)):
+            file_name = self.file_names[file_idx]
+            track = self.track_store.track(file_name)
+            start = rng.randint(track.shape[1] - self.src_len + 1)
+            source[i] = track[rng.randint(track.shape[0]), start:start + self.src_len]
+        return source
@@ -96,6 +96,17 @@ for start_idx in range(0, min(len(signal_1), len(signal_2), len(signal_3)) - sig
 
     gcc_delays = []
     ngcc_delays = []
+    # GCC of all three pairs in one call, every channel is transformed once
+    print('gcc start')
+    cc_pairs = gcc.forward_pairs(x.unsqueeze(0), [[0, 1], [0, 2], [1, 2]]).squeeze(0)
+    print('size cc_pairs = gcc.forward_pairs(x, pairs)', cc_pairs.shape)
+    # NGCC of all three pairs, the backbone runs once per microphone. Localization needs all three
+    # delays, so frames with a quiet pair skip the NGCC
+    p_pairs = None
+    if not any(is_silent(x[pairs[0]]) or is_silent(x[pairs[1]]) for pairs in [[0, 1], [0, 2], [1, 2]]):
+        print('ngcc start')
+        p_pairs = ngcc.forward_pairs(x.unsqueeze(0), [[0, 1], [0, 2], [1, 2]]).squeeze(0)
+        print('size p_pairs = ngcc.forward_pairs(x, pairs)', p_pairs.shape)
     for i, pairs in enumerate([[0, 1], [0, 2], [1, 2]]):
         x1 = x[pairs[0]].unsqueeze(0)
         x2 = x[pairs[1]].unsqueeze(0)
@@ -105,22 +116,22 @@ for start_idx in range(0, min(len(signal_1), len(signal_2), len(signal_3)) - sig
             continue
 
         # Original GCC and NGCC calculation code
-        print('gcc start')
-        cc = gcc(x1, x2).squeeze()
-        print('size cc = gcc(x1, x2).squeeze()', cc.shape)
+        cc = cc_pairs[i]
+        print('size cc = cc_pairs[i]', cc.shape)
         cc = cc / torch.max(cc)
         print('size cc = cc / torch.max(cc)', cc.shape)
-        print('ngcc start')
-        p = ngcc(x1, x2).squeeze()
-        print('size p = ngcc(x1, x2).squeeze()', p.shape)
+        shift_gcc = float(torch.argmax(cc, dim=-1)) - max_tau
+        gcc_delays.append(shift_gcc)
+
+        if p_pairs is None:
+            continue
+        p = p_pairs[i]
+        print('size p = p_pairs[i]', p.shape)
         p = p.detach()
         print('size p = p.detach()', p.shape)
         p = p / torch.max(p)
         print('size p = p / torch.max(p)', p.shape)
-
-        shift_gcc = float(torch.argmax(cc, dim=-1)) - max_tau
         shift_ngcc = float(torch.argmax(p, dim=-1)) - max_tau
-        gcc_delays.append(shift_gcc)
         ngcc_delays.append(shift_ngcc)
 
     # Only localize if we have enough delay estimates
@@ -4,6 +4,8 @@ dataset = 'mic_recording'
 # INPUT PATH
 # Base folder containing the foa/mic and metadata folders
 dataset_dir = 'D:\\MOOD-SENSE\\ngcc-main\\dataset'
+# processes decoding wavs and interpolating labels, 0 uses one per CPU core, 1 runs in the main process
+preprocess_workers = 0
 
 # OUTPUT PATHS
 model_dir='/models'            # Dumps the trained models and training curves in this folder
@@ -21,20 +23,58 @@ print(mic_locs_train[:, 1])
 # Testing environment configuration
 # Training hyperparams
 seed = 0
+split_fractions = [0.7, 0.15, 0.15]  # share of the files in train/val/test, split file by file
+# 'windows': slice windows out of the memory-mapped tracks
+# 'shards': stream pre-windowed shards written next to the dataset, see shards.py
+# 'synthetic': train on examples synthesized on the fly in the DataLoader workers, see augmentation.py
+#              (validation and test still use the recorded windows)
+data_format = 'windows'
+shard_size = 4096  # records per shard
+shuffle_buffer = 8192  # records shuffled together when streaming shards
+synthetic_source = 'tracks'  # 'tracks': snippets of the training recordings, 'noise': white noise
+synthetic_epoch_size = 0  # synthetic examples per epoch, 0 uses as many as there are training windows
+synthetic_snr_db = [5, 40]  # range of the per-microphone SNR
+synthetic_gain_db = [-6, 6]  # range of the per-microphone gain
 batch_size = 32
+# CPU throughput profile, only used when training without a GPU
+num_workers = -1  # DataLoader worker processes, -1 uses a quarter of the CPU cores
+persistent_workers = True  # keep the workers alive between epochs
+prefetch_factor = 4  # batches loaded in advance by every worker
+cpu_threads = 0  # torch intra-op threads, 0 uses the cores not taken by the DataLoader workers
+cpu_interop_threads = 0  # torch inter-op threads, 0 keeps torch's default
 epochs = 30
 lr = 0.001  # learning rate
 wd = 0.0  # weight decay
 ls = 0.0  # label smoothing
 
+# Logging
+# 0: quiet, 1: one summary per epoch and split, 2: one line per batch, 3: tensor shapes in the models
+verbosity = 1
+stage_timers = True  # wall-clock time of data loading, GCC baseline, forward, backward and optimizer step
+metrics_file = 'experiments/NGCC/metrics.jsonl'  # epoch-level metrics, .jsonl or .csv
+debug = False  # autograd anomaly detection, slow
+autocast_bf16 = False  # run NGCCPHAT/PGCCPHAT forward passes under CPU bf16 autocast
+
+model_file = 'experiments/NGCC/model.pth'  # weights saved at the end of training
+
+# Checkpoints
+checkpoint_dir = 'experiments/NGCC/checkpoints'
+checkpoint_every = 1  # epochs between checkpoints
+keep_last_checkpoints = 3  # besides the best one (lowest validation mae)
+
+# Distributed training (model_training_main_.py --nprocs N, or torchrun)
+dist_port = 29500  # rendezvous port of the local processes
+
 # Model parameters
 model = 'NGCCPHAT'  # choices: NGCCPHAT, PGCCPHAT
+pgcc_mlp = 'dense'  # PGCCPHAT layers after the convs: 'dense' (paper, ~167M weights at max_tau 323) or 'compact'
 max_delay = 24 #ms
 num_channels = 128  # number of channels in final layer of NGCCPHAT backbone
 head = 'classifier'  # final layer type. Choices: 'classifier', 'regression'
 loss = 'ce'  # use 'ce' loss for classifier and 'mse' loss for regression
 # Set to true in order to replace Sinc filters with regular convolutional layers
 no_sinc = False
+sinc_layer = 'fast'  # Sinc filter layer: 'fast' (SincConv_fast) or 'legacy' (the original SincNet sinc_conv)
 
 sig_len = 2048  # length of snippet used for tdoa estimation
 
@@ -47,6 +87,10 @@ label_location_fs = int(2000)
 
 # 因此，每 10 个 mic data有一个 location label。
 nb_track_label_ratio = int(mic_fs / label_location_fs) # track_label_resolution
+# 'dense': store one interpolated label per track frame, 'lazy': store the location rows and
+# evaluate the cubic spline only where windows are sampled
+label_mode = 'dense'
+label_dtype = 'float32'  # dtype of the interpolated labels
 
 # threshold in samples
 c = 343 # m/s
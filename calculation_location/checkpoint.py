@@ -0,0 +1,151 @@
+#
+# Periodic training checkpoints written by a background thread
+#
+import os
+import glob
+import json
+import random
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+CHECKPOINT_INDEX_FILE = 'checkpoints.json'
+
+
+def rng_state():
+    """
+    States of every random number generator the training loop draws from
+    """
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _to_cpu(obj):
+    # 在主线程里复制一份，后台线程保存时训练可以继续修改参数
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+class CheckpointManager(object):
+    """
+    Saves training state every few epochs without blocking the training loop.
+
+    save() snapshots the state on the calling thread and hands the file write to a single background
+    thread, so checkpoints are written in order. Only the best checkpoint (lowest `score`) and the
+    last `keep_last` ones are kept; the index file lists them.
+    """
+
+    def __init__(self, checkpoint_dir, keep_last=3, resume=False):
+        """
+        :param resume: continue the run whose checkpoints are in checkpoint_dir. Otherwise the index
+                       starts empty, so `best` and `latest` only name checkpoints of this run; call
+                       clear() to also remove the files of the previous run.
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.index = self._load_index() if resume else {'checkpoints': [], 'best': None}
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = []
+
+    def clear(self):
+        """
+        Removes the checkpoint files and the index left in checkpoint_dir by a previous run
+        """
+        for path in glob.glob(os.path.join(self.checkpoint_dir, 'checkpoint_epoch_*.pt*')):
+            os.remove(path)
+        index_path = os.path.join(self.checkpoint_dir, CHECKPOINT_INDEX_FILE)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+    def _load_index(self):
+        index_path = os.path.join(self.checkpoint_dir, CHECKPOINT_INDEX_FILE)
+        if not os.path.exists(index_path):
+            return {'checkpoints': [], 'best': None}
+        with open(index_path, 'r') as f:
+            return json.load(f)
+
+    def save(self, epoch, state, score=None):
+        """
+        :param epoch: number of finished epochs, names the checkpoint
+        :param state: dict of state_dicts, RNG states and data cursor, see model_training_main_
+        :param score: lower is better, decides which checkpoint is kept as the best
+        """
+        snapshot = _to_cpu(state)
+        self._pending = [future for future in self._pending if not future.done()]
+        self._pending.append(self._executor.submit(self._write, epoch, snapshot, score))
+
+    def _write(self, epoch, snapshot, score):
+        file_name = 'checkpoint_epoch_{:04d}.pt'.format(epoch)
+        path = os.path.join(self.checkpoint_dir, file_name)
+        torch.save(snapshot, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+        index = self.index
+        index['checkpoints'] = [c for c in index['checkpoints'] if c['file'] != file_name]
+        if index['best'] is not None and index['best']['file'] == file_name:
+            # 文件被覆盖，旧的分数不再对应它；best 从剩下的检查点里重新选
+            scored = [c for c in index['checkpoints'] if c['score'] is not None]
+            index['best'] = dict(min(scored, key=lambda c: c['score'])) if scored else None
+        index['checkpoints'].append({'file': file_name, 'epoch': epoch, 'score': score})
+        if score is not None and (index['best'] is None or score < index['best']['score']):
+            index['best'] = {'file': file_name, 'epoch': epoch, 'score': score}
+
+        keep = {c['file'] for c in index['checkpoints'][-self.keep_last:]}
+        if index['best'] is not None:
+            keep.add(index['best']['file'])
+        for c in index['checkpoints']:
+            if c['file'] not in keep and os.path.exists(os.path.join(self.checkpoint_dir, c['file'])):
+                os.remove(os.path.join(self.checkpoint_dir, c['file']))
+        index['checkpoints'] = [c for c in index['checkpoints'] if c['file'] in keep]
+
+        index_path = os.path.join(self.checkpoint_dir, CHECKPOINT_INDEX_FILE)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(index_path + '.tmp', index_path)
+        print('\tcheckpoint saved: {}'.format(path))
+
+    def wait(self):
+        """
+        Blocks until every submitted checkpoint is on disk, re-raising errors of the writer thread
+        """
+        for future in self._pending:
+            future.result()
+        self._pending = []
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+    def latest(self):
+        """
+        :return: path of the most recent checkpoint, None if there is none
+        """
+        if not self.index['checkpoints']:
+            return None
+        return os.path.join(self.checkpoint_dir, self.index['checkpoints'][-1]['file'])
+
+    def best(self):
+        if self.index['best'] is None:
+            return None
+        return os.path.join(self.checkpoint_dir, self.index['best']['file'])
+
+
+def load_checkpoint(path):
+    # 检查点里有 numpy/python 的随机数状态，不能用 weights_only
+    return torch.load(path, map_location='cpu', weights_only=False)
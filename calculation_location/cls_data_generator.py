@@ -8,19 +8,44 @@
 import os
 import shutil
 import wave
+import json
+import hashlib
+import time
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import random
 from collections import defaultdict
 
 # Set environment variable to avoid OpenMP error
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
-import csv
 from scipy import interpolate
 import torch
 import cfg
 
+# Track store: every channel of every group back to back in one int16 array,
+# located through an index of (group, channel, start, length) rows.
+TRACK_DATA_FILE = 'tracks.npy'
+TRACK_INDEX_FILE = 'tracks_index.npy'
+TRACK_INDEX_DTYPE = np.dtype([('group', 'U32'), ('channel', np.int16),
+                              ('start', np.int64), ('length', np.int64)])
+
+# per-group sizes, mtimes and content hashes of the sources, plus the cfg values the outputs depend on
+MANIFEST_FILE = 'manifest.json'
+
+# binary copy of a parsed location csv and the signature of the csv it came from, stored next to it
+# as '<name>.csv.npz'; '.npy' was the suffix of the earlier caches that carried no signature
+LOCATION_CACHE_SUFFIX = '.npz'
+LEGACY_LOCATION_CACHE_SUFFIX = '.npy'
+
+# microphone pairs used for training, in the order they are laid out by generate()
+MIC_PAIRS = [[0, 1], [0, 2], [1, 2]]
+
 class DataGenerator(object):
-    def __init__(self, cfg, split=1, shuffle=True):
+    def __init__(self, cfg, split=1, shuffle=True, read_only=False):
+        """
+        :param read_only: open the track store and labels as they are, without bringing them up to
+                          date; for processes reading what another process has just preprocessed
+        """
         self._dataset_dir = cfg.dataset_dir
         self._dataset_combination = '{}_{}'.format(cfg.dataset, 'dev')
         # 读取wav的文件夹
@@ -36,13 +61,19 @@ class DataGenerator(object):
         self.c = cfg.c
         self.label_location_fs=cfg.label_location_fs
         self.nb_track_label_ratio=cfg.nb_track_label_ratio
+        self.label_mode = cfg.label_mode
+        self.label_dtype = cfg.label_dtype
         self._label_len = None  # total length of label
+        self._filenames_list = None
         self.mic_locs = cfg.mic_locs_train
         self.max_tau = cfg.max_delay
         lower_bound = 0
         upper_bound = self.mic_fs * cfg.audio_length_s
         self.lower_bound = lower_bound
         self.upper_bound = upper_bound
+        if read_only:
+            # 其他进程已经预处理完，这里不检查源文件，也不删文件、不写 manifest
+            return
 
         # read tracks
         # 从 _wav_path 读取signal数据放到 track_path 中，提取track长度，
@@ -50,26 +81,180 @@ class DataGenerator(object):
         # 将低分辨率的数据进行填充放进。
         # 在每个对应signal data都得到一列客观的delay。
 
+        # 只重新处理新增或改动过的 group：manifest 记录每个源文件的大小、mtime、内容哈希以及相关的 cfg 参数。
+        create_folder(self._track_dir)
+        create_folder(self._label_dir)
+        manifest = load_manifest(self._track_dir)
+        params = preprocessing_params(cfg)
+        old_groups = manifest['groups'] if manifest.get('params') == params else {}
+        groups, stale_tracks, stale_labels = scan_sources(
+            self._wav_dir, self._location_dir, self._label_dir, old_groups)
+        if manifest.get('label_params') != label_params(cfg):
+            stale_labels = set(groups)
+        if not track_store_exists(self._track_dir):
+            stale_tracks = set(groups)
+
         print('\n\n---------------- Extracting track: -------------------------------------------------------------------')
         print('\t\tfrom wav_dir {} to track_dir {}'.format(self._wav_dir, self._track_dir))
-        create_folder(self._track_dir)
-        filewise_frames_min = process_audio_files(self._wav_dir, self._track_dir)
-        
+        if stale_tracks or set(groups) != set(old_groups):
+            print('\t\t{} new or changed groups, {} deleted'.format(
+                len(stale_tracks), len(set(old_groups) - set(groups))))
+            filewise_frames_min = process_audio_files(
+                self._wav_dir, self._track_dir, reuse_groups=set(groups) - stale_tracks,
+                nb_workers=cfg.preprocess_workers)
+        else:
+            print('\t\ttrack store up to date')
+            track_store = TrackStore(self._track_dir)
+            filewise_frames_min = {group_id: track_store.nb_frames(group_id) for group_id in track_store.groups}
+
         print('\n\n---------------- Extracting labels: -------------------------------------------------------------------')
         print('\t\tfrom _location_dir {} to _label_dir {}'.format(self._location_dir, self._label_dir))
-        create_folder(self._label_dir)
-        process_location_files(self._location_dir, self._label_dir, filewise_frames_min, self.nb_track_label_ratio)
+        stale_labels = sorted(group_id for group_id in (stale_labels | stale_tracks) & set(filewise_frames_min)
+                              if groups[group_id]['csv'] is not None)
+        for file_name in os.listdir(self._label_dir):
+            group_id = file_name[:-len('.npy')]
+            if file_name.endswith('.npy') and (group_id not in groups or groups[group_id]['csv'] is None
+                                               or group_id in stale_labels):
+                os.remove(os.path.join(self._label_dir, file_name))
+        for file_name in os.listdir(self._location_dir):
+            # parsed csv caches whose csv was deleted, and caches of the old format
+            if file_name.endswith('.csv' + LOCATION_CACHE_SUFFIX) and \
+                    not os.path.exists(os.path.join(self._location_dir, file_name[:-len(LOCATION_CACHE_SUFFIX)])) or \
+                    file_name.endswith('.csv' + LEGACY_LOCATION_CACHE_SUFFIX):
+                os.remove(os.path.join(self._location_dir, file_name))
+        if stale_labels:
+            process_location_files(self._location_dir, self._label_dir, filewise_frames_min, self.nb_track_label_ratio,
+                                   file_names=[groups[group_id]['csv']['name'] for group_id in stale_labels],
+                                   nb_workers=cfg.preprocess_workers, label_mode=self.label_mode,
+                                   label_dtype=self.label_dtype)
+        else:
+            print('\t\tlabels up to date')
+        new_manifest = {'params': params, 'label_params': label_params(cfg), 'groups': groups}
+        if json.loads(json.dumps(new_manifest)) != manifest:
+            save_manifest(self._track_dir, new_manifest)
         # 读取_location_dir中的每个csv文件中的label_mat，得到其长度，
         # 然后与track的长度进行比较，补齐处理，最后得到的就是对应每个wav在每个时刻的值 + 对应的坐标。
-    def generate(self):
+
+    def generate(self, with_targets=True):
+        """
+        :param with_targets: also build the per-sample targets, not needed when training from window_labels()
+        :return: (1, nb_samples) tensors of x1, x2 and targets (None without targets), laid out file by file and pair by pair
+        """
+        if self._filenames_list is None:
+            self._select_files()
+        # Size everything up front and fill preallocated buffers, file by file and pair by pair
+        print('\n\n---------------------getting all dataset------------------------')
+        file_frames = [self._nb_label_frames(file_name) for file_name in self._filenames_list]
+        total = len(MIC_PAIRS) * sum(file_frames)
+        all_data1 = np.empty(total, dtype=np.float32)
+        all_data2 = np.empty(total, dtype=np.float32)
+        all_targets = np.empty(total if with_targets else 0, dtype=np.float32)
+        offset = 0
+        for file_name, nb_frames in zip(self._filenames_list, file_frames):
+            temp_track = self._track_store.track(file_name)
+            if with_targets:
+                temp_label = self.load_labels(file_name, np.arange(nb_frames))
+                source_loc = temp_label[1:4, :].T  # 转置以匹配维度
+                gt_target = pair_delays(self.mic_locs, source_loc, self.mic_fs, self.c) + self.max_tau
+                print('{}: {} frames, gt_target.shape:{}'.format(file_name, nb_frames, gt_target.shape))
+            for pair_id, pairs in enumerate(MIC_PAIRS):
+                all_data1[offset:offset + nb_frames] = temp_track[pairs[0], :nb_frames]
+                all_data2[offset:offset + nb_frames] = temp_track[pairs[1], :nb_frames]
+                if with_targets:
+                    all_targets[offset:offset + nb_frames] = gt_target[:, pair_id]
+                offset += nb_frames
+
+        # 将所有数据转换为一维张量
+        final_tensor1 = torch.from_numpy(all_data1).view(1, -1)
+        final_tensor2 = torch.from_numpy(all_data2).view(1, -1)
+        final_targets = torch.from_numpy(all_targets).view(1, -1) if with_targets else None
+
+        print('Final tensors shapes:')
+        print('final_tensor1.shape:', final_tensor1.shape)
+        print('final_tensor2.shape:', final_tensor2.shape)
+        if with_targets:
+            print('final_targets.shape:', final_targets.shape)
+
+        print('\n\n------------------------all dataset ready------------------------------')
+
+        return final_tensor1, final_tensor2, final_targets
+
+    def window_labels(self, sig_len, stride, with_range=False):
+        """
+        Per-window label table, one row per (file, pair, window start), replacing per-sample targets
+
+        Windows never straddle two files or two pairs. 'offset' locates the window in the layout of
+        generate(), 'delay' is the mean ground-truth delay in samples over the window (without the
+        max_tau offset of the generate() targets). In lazy label mode the spline is only evaluated at
+        the window centres (and ends for the range) instead of at every sample.
+
+        :param sig_len: window length in samples
+        :param stride: hop between window starts in samples
+        :param with_range: add the per-window 'delay_min' and 'delay_max'
+        :return: structured array with fields file (index into file_names), pair, start, offset, delay
+        """
+        if self._filenames_list is None:
+            self._select_files()
+        fields = [('file', np.int32), ('pair', np.int8), ('start', np.int64), ('offset', np.int64), ('delay', np.float32)]
+        if with_range:
+            fields += [('delay_min', np.float32), ('delay_max', np.float32)]
+        tables = []
+        offset = 0
+        for file_cnt, file_name in enumerate(self._filenames_list):
+            nb_frames = self._nb_label_frames(file_name)
+            starts = np.arange(0, nb_frames - sig_len + 1, stride, dtype=np.int64)
+            table = np.zeros((len(MIC_PAIRS), len(starts)), dtype=fields)
+            table['file'] = file_cnt
+            table['pair'] = np.arange(len(MIC_PAIRS))[:, None]
+            table['start'] = starts
+            table['offset'] = offset + np.arange(len(MIC_PAIRS))[:, None] * nb_frames + starts
+            if self.label_mode == 'lazy':
+                centres = self._window_delays(file_name, starts + sig_len // 2)
+                table['delay'] = centres.T
+                if with_range:
+                    ends = np.stack([self._window_delays(file_name, starts), centres,
+                                     self._window_delays(file_name, starts + sig_len - 1)])
+                    table['delay_min'] = ends.min(axis=0).T
+                    table['delay_max'] = ends.max(axis=0).T
+            else:
+                delays = self._window_delays(file_name, np.arange(nb_frames))
+                cumsum = np.concatenate([np.zeros((1, delays.shape[1])), np.cumsum(delays, axis=0)])
+                table['delay'] = ((cumsum[starts + sig_len] - cumsum[starts]) / sig_len).T
+                if with_range:
+                    windows = np.lib.stride_tricks.sliding_window_view(delays, sig_len, axis=0)[starts]
+                    table['delay_min'] = windows.min(axis=-1).T
+                    table['delay_max'] = windows.max(axis=-1).T
+            tables.append(table.reshape(-1))
+            offset += len(MIC_PAIRS) * nb_frames
+        windows = np.concatenate(tables) if tables else np.zeros(0, dtype=fields)
+        print('\tnb_windows: {} (sig_len {}, stride {})'.format(len(windows), sig_len, stride))
+        return windows
+
+    @property
+    def file_names(self):
+        return self._filenames_list
+
+    @property
+    def track_store(self):
+        return self._track_store
+
+    def _window_delays(self, file_name, track_frames):
+        # (len(track_frames), nb_pairs) ground-truth delays in samples
+        source_loc = self.load_labels(file_name, track_frames)[1:4, :].T
+        return pair_delays(self.mic_locs, source_loc, self.mic_fs, self.c)
+
+    def _select_files(self):
         self._shuffle = random.shuffle
         self._filenames_list = list()
         self._nb_frames_file = 0   
 
+        self._track_store = TrackStore(self._track_dir)
+
         print('\n\n---------------- Computing some stats about the dataset----------------' )
-        for filename in os.listdir(self._track_dir):
-            if int(filename[4]) in self._splits:
-                self._filenames_list.append(filename)
+        for group_id in self._track_store.groups:
+            if int(group_id[4]) in self._splits and \
+                    os.path.exists(os.path.join(self._label_dir, '{}.npy'.format(group_id))):
+                self._filenames_list.append(group_id)
         print('\tnb_files: {}\n'.format(len(self._filenames_list)))
         print('self._filenames_list is {}'.format(self._filenames_list))
         print('\tDataset: {}, split: {}\n'
@@ -79,125 +264,480 @@ class DataGenerator(object):
         
         if self._shuffle:
             random.shuffle(self._filenames_list)
-        # Gather in lists, and encode labels as indices
-        print('\n\n---------------------getting all dataset------------------------')
-        all_data1, all_data2, all_targets = [], [], []
-        for file_name in self._filenames_list:
-            temp_track = np.load(os.path.join(self._track_dir, file_name))
-            print(temp_track)
-            temp_label = np.load(os.path.join(self._label_dir, file_name))
-            source_loc = temp_label[1:3, :].T  # 转置以匹配维度
-            print('source_loc:{}'.format(source_loc))
-            for pairs in [[0, 1], [0, 2], [1, 2]]:
-                x1 = temp_track[pairs[0], :]
-                x2 = temp_track[pairs[1], :]
-                d = np.sqrt(np.sum((self.mic_locs[:, pairs[0]] - source_loc) ** 2, axis=1)) - \
-                    np.sqrt(np.sum((self.mic_locs[:, pairs[1]] - source_loc) ** 2, axis=1))
-                d = np.round(d, decimals=2)
-                print('d:', d)
-                print('d.shape:{}'.format(d.shape))
-
-                gt_delay = d * self.mic_fs / self.c
-                gt_target = gt_delay + self.max_tau
-                print('gt_delay.shape:{}'.format(gt_target.shape))
-                
-                all_data1.extend(x1)
-                all_data2.extend(x2)
-                all_targets.extend(gt_target)
 
-        # 将所有数据转换为一维张量
-        final_tensor1 = torch.tensor(all_data1, dtype=torch.float).view(1, -1)
-        final_tensor2 = torch.tensor(all_data2, dtype=torch.float).view(1, -1)
-        final_targets = torch.tensor(all_targets, dtype=torch.float).view(1, -1)
+    def load_labels(self, file_name, track_frames):
+        """
+        :return: (4, len(track_frames)) [frame, x, y, z] labels of a group at the given track frames
+        """
+        label = np.load(os.path.join(self._label_dir, '{}.npy'.format(file_name)), mmap_mode='r')
+        if self.label_mode == 'lazy':
+            spline = LabelSpline(label.T, self._track_store.nb_frames(file_name), dtype=self.label_dtype)
+            return spline(track_frames).T
+        return label[:, track_frames]
 
-        print('Final tensors shapes:')
-        print('final_tensor1.shape:', final_tensor1.shape)
-        print('final_tensor2.shape:', final_tensor2.shape)
-        print('final_targets.shape:', final_targets.shape)
+    def _nb_label_frames(self, file_name):
+        # frames usable for a group: the track and its interpolated label may differ in length
+        if self.label_mode == 'lazy':
+            return self._track_store.nb_frames(file_name)
+        label = np.load(os.path.join(self._label_dir, '{}.npy'.format(file_name)), mmap_mode='r')
+        return min(self._track_store.nb_frames(file_name), label.shape[1])
+ 
+class TrackStore(object):
+    """
+    Read-only access to the track store written by process_audio_files.
 
-        print('\n\n------------------------all dataset ready------------------------------')
+    All channels of all groups live back to back in one int16 array which is opened with
+    mmap_mode='r', so opening a multi-hour corpus is instant and only the windows that are
+    actually sliced get paged in. The index holds one (group, channel, start, length) row per channel.
+    """
 
-        return final_tensor1, final_tensor2, final_targets
- 
-def process_audio_files(wav_dir, track_dir):
+    def __init__(self, track_dir):
+        self.track_dir = track_dir
+        self.data = np.load(os.path.join(track_dir, TRACK_DATA_FILE), mmap_mode='r')
+        self.index = np.load(os.path.join(track_dir, TRACK_INDEX_FILE))
+        self._groups = {}
+        for entry in self.index:
+            self._groups.setdefault(str(entry['group']), []).append(
+                (int(entry['channel']), int(entry['start']), int(entry['length'])))
+
+    def __getstate__(self):
+        # DataLoader workers reopen the mapping instead of receiving a pickled copy of the data
+        return {'track_dir': self.track_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['track_dir'])
+
+    def signature(self):
+        """
+        Changes whenever the store is rewritten, for caches of values computed from the tracks
+        """
+        stat = os.stat(os.path.join(self.track_dir, TRACK_DATA_FILE))
+        return '{}-{}'.format(stat.st_size, stat.st_mtime_ns)
+
+    @property
+    def groups(self):
+        return list(self._groups)
+
+    def __len__(self):
+        return len(self._groups)
+
+    def __contains__(self, group):
+        return group in self._groups
+
+    def nb_channels(self, group):
+        return len(self._groups[group])
+
+    def nb_frames(self, group):
+        return self._groups[group][0][2]
+
+    def channel(self, group, channel, start=0, length=None):
+        """
+        :return: memory-mapped view of `length` frames of one channel, starting at frame `start`
+        """
+        _, offset, nb_frames = self._groups[group][channel]
+        if length is None:
+            length = nb_frames - start
+        return self.data[offset + start:offset + start + length]
+
+    def track(self, group):
+        """
+        :return: (nb_channels, nb_frames) memory-mapped view of a whole group
+        """
+        entries = self._groups[group]
+        offset, nb_frames = entries[0][1], entries[0][2]
+        return self.data[offset:offset + len(entries) * nb_frames].reshape(len(entries), nb_frames)
+
+
+class WindowDataset(torch.utils.data.Dataset):
+    """
+    Windows of the memory-mapped track store, addressed by rows of DataGenerator.window_labels().
+
+    Only the (file, pair, start) index is held in memory, every item is a pair of views into the
+    track store plus the window target, so no concatenated copy of the dataset is ever built.
+    When the window table has a 'gcc_shift' column (see with_field), items carry that cached
+    GCC-PHAT baseline estimate as a fourth element.
+    """
+
+    def __init__(self, track_store, file_names, windows, sig_len, delay_offset=0):
+        """
+        :param track_store: TrackStore the windows point into
+        :param file_names: group ids indexed by the 'file' field of the windows
+        :param windows: rows of DataGenerator.window_labels()
+        :param delay_offset: added to the window delays to form the targets
+        """
+        self.track_store = track_store
+        self.file_names = list(file_names)
+        self.windows = windows
+        self.sig_len = sig_len
+        self.delay_offset = delay_offset
+        self.with_baseline = 'gcc_shift' in windows.dtype.names
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __getitem__(self, idx):
+        window = self.windows[idx]
+        file_name = self.file_names[window['file']]
+        pairs = MIC_PAIRS[window['pair']]
+        x1 = self.track_store.channel(file_name, pairs[0], int(window['start']), self.sig_len)
+        x2 = self.track_store.channel(file_name, pairs[1], int(window['start']), self.sig_len)
+        if self.with_baseline:
+            return x1, x2, np.float32(window['delay'] + self.delay_offset), window['gcc_shift']
+        return x1, x2, np.float32(window['delay'] + self.delay_offset)
+
+def collate_windows(batch, dtype=None):
+    """
+    Stacks WindowDataset items into (batch, sig_len) tensors and (batch,) target tensors
+
+    :param dtype: dtype of the signal tensors, None keeps the int16 samples. Converting here moves
+                  the cast into the DataLoader workers.
+    :return: x1, x2, target, plus the cached GCC-PHAT shifts when the items carry them
+    """
+    columns = list(zip(*batch))
+    x1, x2 = torch.from_numpy(np.stack(columns[0])), torch.from_numpy(np.stack(columns[1]))
+    if dtype is not None:
+        x1, x2 = x1.to(dtype), x2.to(dtype)
+    return (x1, x2) + tuple(torch.from_numpy(np.array(column)) for column in columns[2:])
+
+def process_rank():
+    """
+    :return: (rank, world_size) of this process in torch.distributed, (0, 1) when not distributed
+    """
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+def worker_slot(rank=0, world_size=1):
+    """
+    Position of the calling DataLoader worker among the workers of all distributed processes, used by
+    the streaming datasets to split their data. rank/world_size are taken in the main process, where
+    process_rank() is valid.
+
+    :return: (slot, nb_slots)
+    """
+    worker_info = torch.utils.data.get_worker_info()
+    worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+    return rank * num_workers + worker_id, world_size * num_workers
+
+class ShardSampler(torch.utils.data.Sampler):
+    """
+    Every world_size-th index starting at rank, in order. Unlike DistributedSampler it does not pad
+    the shards to equal length, so over all ranks every window is evaluated exactly once.
+    """
+
+    def __init__(self, dataset, world_size, rank):
+        self.indices = range(rank, len(dataset), world_size)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+def with_field(windows, name, values, dtype=np.float32):
+    """
+    Copy of a window table with an extra column, e.g. a per-window baseline estimate
+    """
+    fields = [(n, windows.dtype.fields[n][0]) for n in windows.dtype.names if n != name] + [(name, dtype)]
+    table = np.zeros(len(windows), dtype=fields)
+    for n in windows.dtype.names:
+        if n != name:
+            table[n] = windows[n]
+    table[name] = values
+    return table
+
+def split_by_file(windows, fractions, seed=0):
+    """
+    Splits a window table so that all windows of a file land in the same split
+
+    :param windows: rows of DataGenerator.window_labels()
+    :param fractions: share of the files in each split, e.g. [0.7, 0.15, 0.15] for train/val/test
+    :return: list with one window table per split
+    """
+    files = np.unique(windows['file'])
+    np.random.RandomState(seed).shuffle(files)
+    counts = [max(1, int(round(fraction * len(files)))) for fraction in fractions[1:]]
+    counts = [len(files) - sum(counts)] + counts
+    if counts[0] < 1:
+        raise ValueError('Need at least {} files for a file-level split, got {}'.format(len(fractions), len(files)))
+    bounds = np.cumsum([0] + counts)
+    return [windows[np.isin(windows['file'], files[bounds[i]:bounds[i + 1]])] for i in range(len(counts))]
+
+def process_audio_files(wav_dir, track_dir, reuse_groups=(), nb_workers=1):
+    """
+    Decodes every complete group of 3 wavs into the memory-mapped track store of track_dir
+
+    :param wav_dir: folder with the '<group>_micN.wav' recordings
+    :param track_dir: folder receiving the track store (TRACK_DATA_FILE and TRACK_INDEX_FILE)
+    :param reuse_groups: groups whose wavs are unchanged, copied from the existing store instead of decoded
+    :param nb_workers: decoding processes, see run_jobs
+    :return: dict mapping group id to its number of track frames
+    """
     filewise_frames_min = {}
+    audio_groups = find_audio_groups(wav_dir)
+    old_store = None
+    if reuse_groups and track_store_exists(track_dir):
+        old_store = TrackStore(track_dir)
+
+    # First pass only reads the wav headers, so that the whole store can be laid out up front
+    proper_length = cfg.mic_fs*cfg.audio_length_s
+    layout = []
+    for group_id, file_paths in audio_groups.items():
+        if old_store is not None and group_id in reuse_groups and group_id in old_store:
+            layout.append((group_id, file_paths, old_store.nb_frames(group_id), True))
+        else:
+            nb_track_frames_min = min([proper_length] + [wav_nb_frames(wav_path) for wav_path in file_paths])
+            layout.append((group_id, file_paths, nb_track_frames_min, False))
+
+    index = np.zeros(sum(len(file_paths) for _, file_paths, _, _ in layout), dtype=TRACK_INDEX_DTYPE)
+    row, start = 0, 0
+    for group_id, file_paths, nb_track_frames_min, _ in layout:
+        for channel in range(len(file_paths)):
+            index[row] = (group_id, channel, start, nb_track_frames_min)
+            row += 1
+            start += nb_track_frames_min
+
+    # Second pass fills every slot: unchanged groups are copied from the old store here,
+    # the others are decoded by the worker pool straight into the memory-mapped file
+    data_path = os.path.join(track_dir, TRACK_DATA_FILE)
+    tmp_path = data_path + '.tmp'
+    data = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.int16, shape=(max(start, 1),))
+    row = 0
+    jobs = []
+    for group_id, file_paths, nb_track_frames_min, reused in layout:
+        group_start = index[row]['start']
+        if reused:
+            data[group_start:group_start + len(file_paths) * nb_track_frames_min] = old_store.track(group_id).reshape(-1)
+        else:
+            jobs.append((tmp_path, group_id, file_paths, index[row:row + len(file_paths)]['start'], nb_track_frames_min))
+        row += len(file_paths)
+        filewise_frames_min[f'{group_id}'] = nb_track_frames_min
+    data.flush()
+    for message, _ in run_jobs(decode_group, jobs, nb_workers, 'tracks'):
+        print(message)
+    del data
+    old_store = None  # release the old mapping before replacing the file
+    os.replace(tmp_path, data_path)
+    np.save(os.path.join(track_dir, TRACK_INDEX_FILE), index)
+    return filewise_frames_min
+
+def decode_group(job):
+    """
+    Decodes the wavs of one group into their slots of the track store being written, run by run_jobs
+
+    :return: tuple of (report message, number of bytes written)
+    """
+    data_path, group_id, file_paths, starts, nb_track_frames_min = job
+    data = np.load(data_path, mmap_mode='r+')
+    for wav_path, start in zip(file_paths, starts):
+        data[start:start + nb_track_frames_min] = read_wav(wav_path)[:nb_track_frames_min]
+    data.flush()
+    return f"Stored: {group_id}, number of track frames: {nb_track_frames_min}", \
+        len(file_paths) * nb_track_frames_min * data.itemsize
+
+def find_audio_groups(wav_dir):
+    """
+    :return: dict mapping group id (first 12 characters of the file name) to its 3 sorted wav paths
+    """
     audio_groups = defaultdict(list)
     for file_name in os.listdir(wav_dir):
         if file_name.endswith('.wav'):
             group_id = file_name[:12]
             wav_path = os.path.join(wav_dir, file_name)
             audio_groups[group_id].append(wav_path)
+    return {group_id: sorted(audio_groups[group_id]) for group_id in sorted(audio_groups)
+            if len(audio_groups[group_id]) == 3}
 
-    for group_id, file_paths in audio_groups.items():
-        if len(file_paths) == 3:
-            # Read all audio files
-            audio_data = []
-            for wav_path in sorted(file_paths):
-                with wave.open(wav_path, 'rb') as wf:
-                    frames = wf.getnframes()
-                    audio = np.frombuffer(wf.readframes(frames), dtype=np.int16)
-                    audio_data.append(audio)
-
-            # Find the minimum length
-            proper_length = cfg.mic_fs*cfg.audio_length_s
-            min_length = min(len(audio) for audio in audio_data)
-
-            # Trim all audio to minimum length and stack
-            combined_audio = np.row_stack([audio[:proper_length] for audio in audio_data])
-
-            nb_track_frames_min = proper_length
-            filewise_frames_min[f'{group_id}'] = nb_track_frames_min
-
-            output_filename = f"{group_id}.npy"
-            output_path = os.path.join(track_dir, output_filename)
-            np.save(output_path, combined_audio)
-
-            print(f"Saved: {output_filename}")
-            print(f"Number of track frames: {nb_track_frames_min}")
-    return filewise_frames_min
+def track_store_exists(track_dir):
+    return os.path.exists(os.path.join(track_dir, TRACK_DATA_FILE)) and \
+        os.path.exists(os.path.join(track_dir, TRACK_INDEX_FILE))
+
+def wav_nb_frames(wav_path):
+    with wave.open(wav_path, 'rb') as wf:
+        return wf.getnframes()
+
+def read_wav(wav_path):
+    with wave.open(wav_path, 'rb') as wf:
+        frames = wf.getnframes()
+        return np.frombuffer(wf.readframes(frames), dtype=np.int16)
 
-def location_files_read(_output_format_file):
+def location_files_read(_output_format_file, use_cache=True):
     """
     Loads DCASE output format csv file and returns it as a numpy array
 
+    The whole file is parsed by numpy's C reader in one call, and the result is cached next to the
+    csv as '<csv>.npz' (LOCATION_CACHE_SUFFIX). The cache carries the csv's size, mtime and sha1 and
+    is only used while all of them match, so a csv replaced with the same mtime (cp -p, rsync -t)
+    is parsed again. Hashing the csv is much cheaper than parsing it.
+
     :param _output_format_file: DCASE output format CSV
-    :return: tuple containing:
-             - data_array: numpy array of all data
-             - total_frames: total number of frames (rows in CSV)
-    """
-    data_list = []
-    with open(_output_format_file, 'r') as csvfile:
-        csv_reader = csv.reader(csvfile)
-        for row in csv_reader:
-            # Convert each row to the appropriate data types
-            # [frame, x, y, z]
-            processed_row = [int(row[0]), float(row[1]), float(row[2]), float(row[3])]
-            data_list.append(processed_row)
-    # Convert list to numpy array
-    data_array = np.array(data_list)
+    :param use_cache: read and write the binary cache
+    :return: data_array: (nb_rows, 4) float64 numpy array of [frame, x, y, z] rows
+    """
+    cache_file = _output_format_file + LOCATION_CACHE_SUFFIX
+    if use_cache:
+        signature = file_signature(_output_format_file)
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cache:
+                if all(str(cache[key]) == str(signature[key]) for key in ('size', 'mtime_ns', 'sha1')):
+                    return cache['data']
+    # [frame, x, y, z]
+    data_array = np.loadtxt(_output_format_file, delimiter=',', usecols=(0, 1, 2, 3), dtype=np.float64, ndmin=2)
+    if use_cache:
+        np.savez(cache_file, data=data_array, size=signature['size'], mtime_ns=signature['mtime_ns'],
+                 sha1=signature['sha1'])
     return data_array
 
-def process_location_files(location_dir, location_label_dir, filewise_frames_min,nb_track_label_ratio):
+def process_location_files(location_dir, location_label_dir, filewise_frames_min,nb_track_label_ratio, file_names=None,
+                           nb_workers=1, label_mode='dense', label_dtype='float64'):
+    """
+    :param label_mode: 'dense' saves one interpolated label per track frame, 'lazy' only saves the
+                       trimmed location rows (the spline knots), evaluated later through LabelSpline
+    :param label_dtype: dtype of the dense labels
+    """
     print('filewise_frames_min is {}'.format(filewise_frames_min))
-    for file_cnt, file_name in enumerate(os.listdir(location_dir)):
-        print(file_name)
-        data_array = location_files_read(os.path.join(location_dir, file_name))
-        nb_track_frames_min = filewise_frames_min[file_name.split('.')[0]]
-        # 以 nb_track_frames_min为基准，处理 nb_location_frames，先修剪，再填充成为统一长度。
-        nb_label_minimum = nb_track_frames_min//nb_track_label_ratio
-        if len(data_array) >= nb_label_minimum:
-            # 裁剪数据数组（如果需要）
-            data_array = data_array[:nb_label_minimum]
-            # 使用三次样条插值将标签补齐到与 track 相同的分辨率
-            interpolated_data = interpolate_labels(data_array, nb_track_frames_min)
-            interpolated_data = interpolated_data.T
-            print(f'{file_cnt}: {file_name}, Original shape: {data_array.shape}, Interpolated shape: {interpolated_data.shape}')
-            # 保存插值后的数据
-            np.save(os.path.join(location_label_dir, f'{file_name.split(".")[0]}.npy'), interpolated_data)
-        else:
-            # 如果data_array长度短于nb_label_minimum 那就出了问题。
-            print(f'Error: Data array length ({len(data_array)}) is less than minimum required length ({nb_label_minimum}) for file {file_name}')
+    if file_names is None:
+        file_names = sorted(file_name for file_name in os.listdir(location_dir) if file_name.endswith('.csv'))
+    jobs = []
+    for file_name in file_names:
+        if file_name.split('.')[0] not in filewise_frames_min:
+            print(f'Error: no track for location file {file_name}')
             continue
+        jobs.append((os.path.join(location_dir, file_name), location_label_dir,
+                     filewise_frames_min[file_name.split('.')[0]], nb_track_label_ratio, label_mode, label_dtype))
+    for file_cnt, (message, _) in enumerate(run_jobs(process_location_file, jobs, nb_workers, 'labels')):
+        print(f'{file_cnt}: {message}')
+
+def process_location_file(job):
+    """
+    Interpolates one location csv to the track resolution and saves it as '<group>.npy', run by run_jobs
+
+    :return: tuple of (report message, number of bytes written)
+    """
+    location_path, location_label_dir, nb_track_frames_min, nb_track_label_ratio, label_mode, label_dtype = job
+    file_name = os.path.basename(location_path)
+    data_array = location_files_read(location_path)
+    # 以 nb_track_frames_min为基准，处理 nb_location_frames，先修剪，再填充成为统一长度。
+    nb_label_minimum = nb_track_frames_min//nb_track_label_ratio
+    if len(data_array) >= nb_label_minimum:
+        # 裁剪数据数组（如果需要）
+        data_array = data_array[:nb_label_minimum]
+        if label_mode == 'lazy':
+            # 只保存样条节点，训练时再用 LabelSpline 在需要的位置求值
+            np.save(os.path.join(location_label_dir, f'{file_name.split(".")[0]}.npy'), data_array.T)
+            return f'{file_name}, Original shape: {data_array.shape}, kept as spline knots', data_array.nbytes
+        # 使用三次样条插值将标签补齐到与 track 相同的分辨率
+        interpolated_data = interpolate_labels(data_array, nb_track_frames_min, dtype=label_dtype)
+        interpolated_data = interpolated_data.T
+        # 保存插值后的数据
+        np.save(os.path.join(location_label_dir, f'{file_name.split(".")[0]}.npy'), interpolated_data)
+        return f'{file_name}, Original shape: {data_array.shape}, Interpolated shape: {interpolated_data.shape}', \
+            interpolated_data.nbytes
+    # 如果data_array长度短于nb_label_minimum 那就出了问题。
+    return f'Error: Data array length ({len(data_array)}) is less than minimum required length ({nb_label_minimum}) for file {file_name}', 0
+
+def run_jobs(function, jobs, nb_workers, description):
+    """
+    Maps function over independent jobs on a process pool and reports progress and throughput
+
+    :param function: module-level function taking one job and returning (message, nb_bytes_written)
+    :param nb_workers: number of processes, 0 uses one per CPU core and 1 runs everything in this process
+    :return: list of the results, in job order whatever the number of workers
+    """
+    if nb_workers == 0:
+        nb_workers = os.cpu_count() or 1
+    nb_workers = max(1, min(nb_workers, len(jobs)))
+    results = []
+    start_time = time.time()
+    nb_bytes = 0
+    executor = ProcessPoolExecutor(nb_workers) if nb_workers > 1 else None
+    try:
+        mapped = executor.map(function, jobs) if executor is not None else map(function, jobs)
+        for cnt, result in enumerate(mapped, 1):
+            results.append(result)
+            nb_bytes += result[1]
+            elapsed = max(time.time() - start_time, 1e-9)
+            print('\t[{}/{}] {}: {:.1f} groups/s, {:.1f} MB/s ({} workers)'.format(
+                cnt, len(jobs), description, cnt / elapsed, nb_bytes / elapsed / 1e6, nb_workers))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return results
+
+def preprocessing_params(cfg):
+    """
+    cfg values the tracks and labels depend on, changing any of them invalidates the whole cache
+    """
+    return {'mic_fs': cfg.mic_fs, 'audio_length_s': cfg.audio_length_s,
+            'nb_track_label_ratio': cfg.nb_track_label_ratio}
+
+def label_params(cfg):
+    """
+    cfg values only the label files depend on, changing any of them invalidates the labels
+    """
+    return {'label_mode': cfg.label_mode, 'label_dtype': cfg.label_dtype}
+
+def load_manifest(track_dir):
+    manifest_path = os.path.join(track_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {'params': None, 'groups': {}}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(track_dir, manifest):
+    manifest_path = os.path.join(track_dir, MANIFEST_FILE)
+    tmp_path = '{}.{}.tmp'.format(manifest_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+def file_signature(path, previous=None):
+    """
+    Size, mtime and content hash of a source file. The hash is only recomputed when
+    size or mtime differ from `previous`, which keeps warm starts to a few stat calls.
+    """
+    stat = os.stat(path)
+    signature = {'name': os.path.basename(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if previous is not None and all(previous.get(key) == signature[key] for key in signature):
+        signature['sha1'] = previous['sha1']
+    else:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        signature['sha1'] = sha1.hexdigest()
+    return signature
+
+def same_content(signatures, previous_signatures):
+    return previous_signatures is not None and \
+        [(sig['name'], sig['sha1']) for sig in signatures] == [(sig['name'], sig['sha1']) for sig in previous_signatures]
+
+def scan_sources(wav_dir, location_dir, location_label_dir, old_groups):
+    """
+    Signs the sources of every group and compares them with the previous manifest entries
+
+    :return: tuple containing:
+             - groups: manifest entries, {group: {'wavs': [signature, ...], 'csv': signature or None}}
+             - stale_tracks: groups whose wavs are new or changed
+             - stale_labels: groups whose csv is new or changed, or whose label file is missing
+    """
+    location_files = {file_name.split('.')[0]: file_name for file_name in os.listdir(location_dir)
+                      if file_name.endswith('.csv')}
+    groups, stale_tracks, stale_labels = {}, set(), set()
+    for group_id, wav_paths in find_audio_groups(wav_dir).items():
+        old = old_groups.get(group_id, {})
+        old_wavs = {sig['name']: sig for sig in old.get('wavs', [])}
+        wavs = [file_signature(wav_path, old_wavs.get(os.path.basename(wav_path))) for wav_path in wav_paths]
+        if not same_content(wavs, old.get('wavs')):
+            stale_tracks.add(group_id)
+        csv_sig = None
+        if group_id in location_files:
+            csv_sig = file_signature(os.path.join(location_dir, location_files[group_id]), old.get('csv'))
+            if not same_content([csv_sig], [old['csv']] if old.get('csv') else None) or \
+                    not os.path.exists(os.path.join(location_label_dir, '{}.npy'.format(group_id))):
+                stale_labels.add(group_id)
+        groups[group_id] = {'wavs': wavs, 'csv': csv_sig}
+    return groups, stale_tracks, stale_labels
 
 def create_folder(folder_name):
     if not os.path.exists(folder_name):
@@ -209,14 +749,49 @@ def delete_and_create_folder(folder_name):
         shutil.rmtree(folder_name)
     os.makedirs(folder_name, exist_ok=True)
 
-def interpolate_labels(data_array, nb_track_frames_min):
-        # 创建原始时间轴
-        original_time = np.arange(len(data_array))
+def pair_delays(mic_locs, source_loc, mic_fs, c, pairs=MIC_PAIRS):
+    """
+    Ground-truth delay, in samples, of every microphone pair for every source location
+
+    :param mic_locs: (3, nb_mics) microphone coordinates
+    :param source_loc: (nb_frames, 3) source coordinates
+    :return: (nb_frames, nb_pairs) array of delays
+    """
+    pairs = np.asarray(pairs)
+    dist = np.sqrt(np.sum((mic_locs.T[None, :, :] - source_loc[:, None, :]) ** 2, axis=2))
+    d = dist[:, pairs[:, 0]] - dist[:, pairs[:, 1]]
+    d = np.round(d, decimals=2)
+    return d * mic_fs / c
+
+def interpolate_labels(data_array, nb_track_frames_min, dtype=np.float64):
         # 创建新的时间轴
         new_time = np.linspace(0, len(data_array) - 1, nb_track_frames_min)
-        # 对每个维度进行插值
-        interpolated_data = np.zeros((nb_track_frames_min, data_array.shape[1]))
-        for i in range(data_array.shape[1]):
-            f = interpolate.interp1d(original_time, data_array[:, i], kind='cubic', fill_value="extrapolate")
-            interpolated_data[:, i] = f(new_time)
-        return interpolated_data
\ No newline at end of file
+        # 所有维度一次性拟合同一个三次样条（与 interp1d(kind='cubic') 的 not-a-knot 样条相同）
+        spline = interpolate.make_interp_spline(np.arange(len(data_array)), data_array, k=3, axis=0)
+        return spline(new_time).astype(dtype, copy=False)
+
+class LabelSpline(object):
+    """
+    Cubic spline through the location rows of one file, fitted for all columns in one call.
+
+    Track frame i is mapped onto the label time axis exactly like interpolate_labels does, so
+    calling it on every track frame gives the dense labels, while calling it on the few frames
+    a trainer actually samples avoids materialising a label per audio sample.
+    """
+
+    def __init__(self, data_array, nb_track_frames_min, dtype=np.float64):
+        """
+        :param data_array: (nb_label_frames, nb_columns) location rows, already trimmed
+        :param nb_track_frames_min: number of track frames the labels are stretched over
+        :param dtype: dtype of the evaluated labels
+        """
+        self._spline = interpolate.make_interp_spline(np.arange(len(data_array)), data_array, k=3, axis=0)
+        self._time_scale = (len(data_array) - 1) / max(nb_track_frames_min - 1, 1)
+        self.nb_track_frames_min = nb_track_frames_min
+        self.dtype = dtype
+
+    def __call__(self, track_frames):
+        """
+        :return: (len(track_frames), nb_columns) labels at the given track frames
+        """
+        return self._spline(np.asarray(track_frames) * self._time_scale).astype(self.dtype, copy=False)
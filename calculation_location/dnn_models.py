@@ -8,30 +8,60 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
-from torch.autograd import Variable
 import math
 from torch_same_pad import get_pad
 
+# conv_mode='auto' switches the sinc layers to FFT convolution above this kernel length. On CPU the
+# FFT path costs about the same for any kernel length, direct conv1d grows with it; they meet
+# between 127 and 255 taps for 128 filters on 2048 samples.
+FFT_CONV_MIN_KERNEL = 128
 
 def flip(x, dim):
-    xsize = x.size()
-    dim = x.dim() + dim if dim < 0 else dim
-    x = x.contiguous()
-    x = x.view(-1, *xsize[dim:])
-    x = x.view(x.size(0), x.size(1), -1)[:, getattr(torch.arange(x.size(1)-1,
-                                                                 -1, -1), ('cpu', 'cuda')[x.is_cuda])().long(), :]
-    return x.view(xsize)
+    return torch.flip(x, dims=[dim])
 
 
 def sinc(band, t_right):
+    """
+    Symmetric sinc of every band, on whatever device band and t_right are
+
+    band: scalar, or (N_filt, 1) to get one filter per row
+    t_right: (T,) positive time axis
+    returns: (2T + 1,) or (N_filt, 2T + 1)
+    """
     y_right = torch.sin(2*math.pi*band*t_right)/(2*math.pi*band*t_right)
-    y_left = flip(y_right, 0)
+    y_left = flip(y_right, -1)
 
-    y = torch.cat([y_left, Variable(torch.ones(1)).cuda(), y_right])
+    y = torch.cat([y_left, torch.ones_like(y_right[..., :1]), y_right], dim=-1)
 
     return y
 
 
+def use_fft_conv(conv_mode, kernel_size, n_samples, padding, stride=1, dilation=1):
+    """
+    Whether a circularly padded convolution runs in the frequency domain, see SincConv_fast.
+    That path only covers 'same' output length with unit stride and dilation.
+    """
+    if conv_mode == 'direct' or (conv_mode == 'auto' and kernel_size <= FFT_CONV_MIN_KERNEL):
+        return False
+    return padding[0] + padding[1] == kernel_size - 1 and kernel_size <= n_samples \
+        and stride == 1 and dilation == 1
+
+
+def circular_filter_spectrum(filters, n_samples, left):
+    """
+    Conjugate spectrum of (N_filt, 1, kernel_size) filters placed on a circle of n_samples, tap
+    `left` at lag 0, so that irfft(rfft(x) * spectrum) correlates x with the filters like conv1d
+    does on x circularly padded by `left` samples on the left
+    """
+    taps = F.pad(filters[:, 0], (0, n_samples - filters.shape[-1]))
+    return torch.conj(torch.fft.rfft(torch.roll(taps, -left, dims=-1), n=n_samples))
+
+
+def circular_conv_fft(waveforms, spectrum):
+    n_samples = waveforms.shape[-1]
+    return torch.fft.irfft(torch.fft.rfft(waveforms, n=n_samples) * spectrum, n=n_samples)
+
+
 class SincConv_fast(nn.Module):
     """Sinc-based convolution
     Parameters
@@ -44,6 +74,9 @@ class SincConv_fast(nn.Module):
         Filter length.
     sample_rate : `int`, optional
         Sample rate. Defaults to 16000.
+    conv_mode : `str`, optional
+        How circular() applies the filters: 'direct' pads and runs conv1d, 'fft' multiplies
+        spectra, 'auto' uses 'fft' for kernels longer than FFT_CONV_MIN_KERNEL. Defaults to 'auto'.
     Usage
     -----
     See `torch.nn.Conv1d`
@@ -63,7 +96,8 @@ class SincConv_fast(nn.Module):
         return 700 * (10 ** (mel / 2595) - 1)
 
     def __init__(self, out_channels, kernel_size, sample_rate=16000, in_channels=1,
-                 stride=1, padding=0, dilation=1, bias=False, groups=1, min_low_hz=50, min_band_hz=50):
+                 stride=1, padding=0, dilation=1, bias=False, groups=1, min_low_hz=50, min_band_hz=50,
+                 conv_mode='auto'):
 
         super(SincConv_fast, self).__init__()
 
@@ -89,6 +123,9 @@ class SincConv_fast(nn.Module):
             raise ValueError('SincConv does not support bias.')
         if groups > 1:
             raise ValueError('SincConv does not support groups.')
+        if conv_mode not in ('auto', 'direct', 'fft'):
+            raise ValueError('Unsupported conv_mode: %s' % conv_mode)
+        self.conv_mode = conv_mode
 
         self.sample_rate = sample_rate
         self.min_low_hz = min_low_hz
@@ -121,6 +158,9 @@ class SincConv_fast(nn.Module):
         # Due to symmetry, I only need half of the time axes
         self.n_ = 2*math.pi*torch.arange(-n, 0).view(1, -1) / self.sample_rate
 
+        # eval-mode filter bank and its spectra, see filter_bank()
+        self._filter_cache = None
+
     def forward(self, waveforms):
         """
         Parameters
@@ -133,9 +173,67 @@ class SincConv_fast(nn.Module):
             Batch of sinc filters activations.
         """
 
-        self.n_ = self.n_.to(waveforms.device)
+        self.filters = self.filter_bank()
+
+        return F.conv1d(waveforms, self.filters, stride=self.stride,
+                        padding=self.padding, dilation=self.dilation,
+                        bias=None, groups=1)
+
+    def circular(self, waveforms, padding):
+        """
+        Same as forward(F.pad(waveforms, padding, mode='circular')), computed as a circular
+        convolution in the frequency domain when conv_mode selects it.
+        Parameters
+        ----------
+        waveforms : `torch.Tensor` (batch_size, 1, n_samples)
+            Batch of unpadded waveforms.
+        padding : `tuple` (left, right)
+            Circular padding of the direct path.
+        Returns
+        -------
+        features : `torch.Tensor` (batch_size, out_channels, n_samples_out)
+        """
+        n_samples = waveforms.shape[-1]
+        if self.padding != 0 or not use_fft_conv(self.conv_mode, self.kernel_size, n_samples, padding,
+                                                  self.stride, self.dilation):
+            return self.forward(F.pad(waveforms, pad=padding, mode='circular'))
+
+        self.filters = self.filter_bank()
+        spectrum = self.filter_spectrum(self.filters, n_samples, padding[0])
+
+        return circular_conv_fft(waveforms, spectrum)
+
+    def filter_spectrum(self, filters, n_samples, left):
+        """
+        circular_filter_spectrum(), kept with the cached filter bank in eval mode
+        """
+        cache = self._filter_cache
+        if cache is not None and cache[1] is filters and (n_samples, left) in cache[2]:
+            return cache[2][(n_samples, left)]
+
+        spectrum = circular_filter_spectrum(filters, n_samples, left)
+        if cache is not None and cache[1] is filters:
+            cache[2][(n_samples, left)] = spectrum
+        return spectrum
 
-        self.window_ = self.window_.to(waveforms.device)
+    def filter_bank(self):
+        """
+        Returns
+        -------
+        filters : `torch.Tensor` (out_channels, 1, kernel_size)
+            Band-pass filters of the current low_hz_ and band_hz_. In eval mode without autograd
+            they are built once and reused until the parameters change (optimizer step,
+            load_state_dict, moving the module).
+        """
+        cacheable = not self.training and not torch.is_grad_enabled()
+        key = (self.low_hz_._version, self.band_hz_._version,
+               self.low_hz_.data_ptr(), self.band_hz_.data_ptr())
+        if cacheable and self._filter_cache is not None and self._filter_cache[0] == key:
+            return self._filter_cache[1]
+
+        self.n_ = self.n_.to(self.low_hz_.device)
+
+        self.window_ = self.window_.to(self.low_hz_.device)
 
         low = self.min_low_hz + torch.abs(self.low_hz_)
 
@@ -157,17 +255,24 @@ class SincConv_fast(nn.Module):
 
         band_pass = band_pass / (2*band[:, None])
 
-        self.filters = (band_pass).view(
+        filters = (band_pass).view(
             self.out_channels, 1, self.kernel_size)
 
-        return F.conv1d(waveforms, self.filters, stride=self.stride,
-                        padding=self.padding, dilation=self.dilation,
-                        bias=None, groups=1)
+        if cacheable:
+            self._filter_cache = (key, filters, {})
+        else:
+            self._filter_cache = None
+        return filters
 
 
 class sinc_conv(nn.Module):
+    """
+    Original SincNet layer: band-pass filters from two learnt cut-off frequencies, normalised to a
+    peak of 1 and Hamming windowed. All filters are generated in one batched op on the device of the
+    parameters; conv_mode selects the convolution of circular() as in SincConv_fast.
+    """
 
-    def __init__(self, N_filt, Filt_dim, fs):
+    def __init__(self, N_filt, Filt_dim, fs, conv_mode='auto'):
         super(sinc_conv, self).__init__()
 
         # Mel Initialization of the filterbanks
@@ -190,13 +295,18 @@ class sinc_conv(nn.Module):
         self.N_filt = N_filt
         self.Filt_dim = Filt_dim
         self.fs = fs
+        if conv_mode not in ('auto', 'direct', 'fft'):
+            raise ValueError('Unsupported conv_mode: %s' % conv_mode)
+        self.conv_mode = conv_mode
 
-    def forward(self, x):
-
-        filters = Variable(torch.zeros((self.N_filt, self.Filt_dim))).cuda()
+    def filter_bank(self):
+        """
+        returns: (N_filt, 1, Filt_dim) float32 filters
+        """
+        device = self.filt_b1.device
         N = self.Filt_dim
-        t_right = Variable(torch.linspace(
-            1, (N-1)/2, steps=int((N-1)/2))/self.fs).cuda()
+        t_right = torch.linspace(
+            1, (N-1)/2, steps=int((N-1)/2), device=device)/self.fs
 
         min_freq = 50.0
         min_band = 50.0
@@ -204,31 +314,45 @@ class sinc_conv(nn.Module):
         filt_beg_freq = torch.abs(self.filt_b1)+min_freq/self.freq_scale
         filt_end_freq = filt_beg_freq + \
             (torch.abs(self.filt_band)+min_band/self.freq_scale)
+        filt_beg_freq = filt_beg_freq.float().view(-1, 1)
+        filt_end_freq = filt_end_freq.float().view(-1, 1)
 
-        n = torch.linspace(0, N, steps=N)
+        n = torch.linspace(0, N, steps=N, device=device)
 
         # Filter window (hamming)
         window = 0.54-0.46*torch.cos(2*math.pi*n/N)
-        window = Variable(window.float().cuda())
 
-        for i in range(self.N_filt):
+        # one row per filter
+        low_pass1 = 2 * \
+            filt_beg_freq*sinc(filt_beg_freq * self.freq_scale, t_right)
+        low_pass2 = 2 * \
+            filt_end_freq*sinc(filt_end_freq * self.freq_scale, t_right)
+        band_pass = (low_pass2-low_pass1)
+
+        band_pass = band_pass/torch.max(band_pass, dim=1, keepdim=True)[0]
+
+        filters = band_pass*window
 
-            low_pass1 = 2 * \
-                filt_beg_freq[i].float()*sinc(filt_beg_freq[i].float()
-                                              * self.freq_scale, t_right)
-            low_pass2 = 2 * \
-                filt_end_freq[i].float()*sinc(filt_end_freq[i].float()
-                                              * self.freq_scale, t_right)
-            band_pass = (low_pass2-low_pass1)
+        return filters.view(self.N_filt, 1, self.Filt_dim)
 
-            band_pass = band_pass/torch.max(band_pass)
+    def forward(self, x):
 
-            filters[i, :] = band_pass.cuda()*window
+        filters = self.filter_bank()
 
-        out = F.conv1d(x, filters.view(self.N_filt, 1, self.Filt_dim))
+        out = F.conv1d(x, filters)
 
         return out
 
+    def circular(self, x, padding):
+        """
+        Same as forward(F.pad(x, padding, mode='circular')), see SincConv_fast.circular
+        """
+        if not use_fft_conv(self.conv_mode, self.Filt_dim, x.shape[-1], padding):
+            return self.forward(F.pad(x, pad=padding, mode='circular'))
+
+        filters = self.filter_bank()
+        return circular_conv_fft(x, circular_filter_spectrum(filters, x.shape[-1], padding[0]))
+
 
 def act_fun(act_type):
 
@@ -392,6 +516,10 @@ class SincNet(nn.Module):
        self.act = nn.ModuleList([])
        self.drop = nn.ModuleList([])
        self.use_sinc = options['use_sinc']
+       # 'fast': SincConv_fast, 'legacy': the original SincNet sinc_conv
+       self.sinc_layer = options.get('sinc_layer', 'fast')
+       if self.sinc_layer not in ('fast', 'legacy'):
+           raise ValueError('Unsupported sinc_layer: %s' % self.sinc_layer)
 
        if self.cnn_use_laynorm_inp:
            self.ln0 = LayerNorm(self.input_dim)
@@ -418,7 +546,10 @@ class SincNet(nn.Module):
          self.bn.append(nn.BatchNorm1d(N_filt, momentum=0.05))
 
          if i == 0:
-          if self.use_sinc:
+          if self.use_sinc and self.sinc_layer == 'legacy':
+            self.conv.append(sinc_conv(
+                self.cnn_N_filt[0], self.cnn_len_filt[0], self.fs))
+          elif self.use_sinc:
             self.conv.append(SincConv_fast(
                 self.cnn_N_filt[0], self.cnn_len_filt[0], self.fs))
           else:
@@ -451,23 +582,27 @@ class SincNet(nn.Module):
          s = x.shape[2]
          padding = get_pad(
              size=s, kernel_size=self.cnn_len_filt[i], stride=1, dilation=1)
-         x = F.pad(x, pad=padding, mode='circular')
+         if isinstance(self.conv[i], (SincConv_fast, sinc_conv)):
+          # the sinc layers do the circular padding themselves, their FFT path needs no padded copy
+          x = self.conv[i].circular(x, padding)
+         else:
+          x = self.conv[i](F.pad(x, pad=padding, mode='circular'))
 
          if self.cnn_use_laynorm[i]:
           if i == 0:
            x = self.drop[i](self.act[i](self.ln[i](F.max_pool1d(
-               torch.abs(self.conv[i](x)), self.cnn_max_pool_len[i]))))
+               torch.abs(x), self.cnn_max_pool_len[i]))))
           else:
            x = self.drop[i](self.act[i](self.ln[i](
-               F.max_pool1d(self.conv[i](x), self.cnn_max_pool_len[i]))))
+               F.max_pool1d(x, self.cnn_max_pool_len[i]))))
 
          if self.cnn_use_batchnorm[i]:
           x = self.drop[i](self.act[i](self.bn[i](
-              F.max_pool1d(self.conv[i](x), self.cnn_max_pool_len[i]))))
+              F.max_pool1d(x, self.cnn_max_pool_len[i]))))
 
          if self.cnn_use_batchnorm[i] == False and self.cnn_use_laynorm[i] == False:
           x = self.drop[i](self.act[i](F.max_pool1d(
-              self.conv[i](x), self.cnn_max_pool_len[i])))
+              x, self.cnn_max_pool_len[i])))
 
        #x = x.view(batch,-1)
 
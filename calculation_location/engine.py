@@ -0,0 +1,176 @@
+#
+# Epoch runner shared by the train, validation and test splits
+#
+import os
+import time
+import contextlib
+import numpy as np
+import torch
+from tqdm import tqdm
+
+import metrics
+
+
+def gcc_shifts(gcc, x1, x2, max_tau_gcc):
+    """
+    Delay estimates of the classical GCC baseline: the lag of the correlation peak, in samples
+    """
+    cc = gcc(x1, x2)
+    return torch.argmax(cc, dim=-1) - max_tau_gcc
+
+
+def window_gcc_shifts(dataset, gcc, max_tau_gcc, cache_file=None, fingerprint=None, batch_size=256):
+    """
+    GCC baseline estimate of every window of a cls_data_generator.WindowDataset, computed once
+
+    The estimates do not depend on the model, so they are cached in `cache_file` together with the
+    fingerprint of the windows and tracks they were computed from, and reused while it matches.
+
+    :return: (len(dataset),) float32 array of delays in samples
+    """
+    if cache_file and os.path.exists(cache_file):
+        cache = np.load(cache_file)
+        if str(cache['fingerprint']) == fingerprint and len(cache['shift']) == len(dataset):
+            return cache['shift']
+
+    print('\t\tcomputing the GCC baseline of {} windows'.format(len(dataset)))
+    shifts = np.empty(len(dataset), dtype=np.float32)
+    with torch.inference_mode():
+        for start in range(0, len(dataset), batch_size):
+            items = [dataset[i] for i in range(start, min(start + batch_size, len(dataset)))]
+            x1 = torch.from_numpy(np.stack([item[0] for item in items])).float()
+            x2 = torch.from_numpy(np.stack([item[1] for item in items])).float()
+            shifts[start:start + len(items)] = gcc_shifts(gcc, x1, x2, max_tau_gcc).numpy()
+
+    if cache_file:
+        np.savez(cache_file, fingerprint=np.array(fingerprint), shift=shifts)
+    return shifts
+
+
+class EpochRunner(object):
+    """
+    Runs one pass of a model over a DataLoader and reports the same metrics for every split.
+
+    Training passes (optimizer given) run with autograd, evaluation passes under
+    torch.inference_mode. Targets are delays offset by max_tau, as built by the datasets.
+    Under torch.distributed the metrics are summed over all processes before they are reported, and
+    DistributedDataParallel models train inside join(), so ranks may see different batch counts.
+    """
+
+    def __init__(self, model, loss_fn, gcc, max_tau, max_tau_gcc, t, device, loss='ce', logger=None,
+                 autocast=False):
+        """
+        :param gcc: classical GCC baseline, its mae/acc are reported next to the model's. Batches
+                    that carry cached baseline shifts (see window_gcc_shifts) skip it.
+        :param max_tau_gcc: max_tau of gcc
+        :param t: accuracy threshold in samples
+        :param loss: 'ce' for the classifier head, 'mse' for the regression head
+        :param logger: metrics.MetricsLogger the epoch records and stage times go to
+        :param autocast: run forward and loss under CPU bf16 autocast
+        """
+        self.model = model
+        self.loss_fn = loss_fn
+        self.gcc = gcc
+        self.max_tau = max_tau
+        self.max_tau_gcc = max_tau_gcc
+        self.t = t
+        self.device = device
+        self.loss = loss
+        self.logger = logger if logger is not None else metrics.MetricsLogger(timers=False)
+        self.autocast = autocast
+
+    def run(self, loader, split, epoch, optimizer=None, **extra):
+        """
+        :param optimizer: trains the model when given, evaluates it otherwise
+        :param extra: additional values for the epoch record, e.g. the learning rate
+        :return: the epoch record, see metrics.MetricsLogger.epoch
+        """
+        training = optimizer is not None
+        self.model.train(training)
+        grad_mode = contextlib.nullcontext() if training else torch.inference_mode()
+        join = contextlib.nullcontext()
+        if training and isinstance(self.model, torch.nn.parallel.DistributedDataParallel):
+            join = self.model.join()
+        logger = self.logger
+
+        loss_sum = 0.
+        mae = gcc_mae = acc = gcc_acc = 0.
+        nb_samples = 0
+        epoch_start = time.perf_counter()
+        if isinstance(loader.dataset, torch.utils.data.IterableDataset):
+            total = len(loader.dataset)
+        else:
+            total = len(loader.sampler)  # this process's share under a DistributedSampler
+        with grad_mode, join, tqdm(total=total, disable=metrics.VERBOSITY < metrics.EPOCH) as pbar:
+            for batch_idx, batch in enumerate(logger.timed(loader)):
+                x1, x2, target = batch[:3]
+                # 重塑 x1 和 x2
+                x1 = x1.float().unsqueeze(1).to(self.device)
+                x2 = x2.float().unsqueeze(1).to(self.device)
+                delays = target.float().to(self.device)
+                metrics.debug('x1.shape:', x1.shape, 'x2.shape:', x2.shape, 'delays.shape:', delays.shape)
+                bs = x1.shape[0]
+
+                if len(batch) > 3:
+                    # GCC-PHAT 基线在建数据集时已经算好，直接拿来用
+                    shift_gcc = batch[3].to(self.device)
+                else:
+                    with logger.timer('gcc'):
+                        shift_gcc = gcc_shifts(self.gcc, x1.squeeze(1), x2.squeeze(1), self.max_tau_gcc)
+
+                with logger.timer('forward'):
+                    loss, shift = self.forward(x1, x2, delays)
+
+                if training:
+                    optimizer.zero_grad()
+                    with logger.timer('backward'):
+                        loss.backward()
+                    with logger.timer('optimizer'):
+                        optimizer.step()
+
+                gt = delays - self.max_tau
+                mae += torch.sum(torch.abs(shift - gt)).item()
+                gcc_mae += torch.sum(torch.abs(shift_gcc - gt)).item()
+                acc += torch.sum(torch.abs(shift - gt) < self.t).item()
+                gcc_acc += torch.sum(torch.abs(shift_gcc - gt) < self.t).item()
+                loss_sum += loss.detach().item() * bs
+                nb_samples += bs
+                if metrics.VERBOSITY >= metrics.BATCH:
+                    print('{} batch {}: loss {:.4f}'.format(split, batch_idx, loss.item()))
+                pbar.update(bs)
+        epoch_time = time.perf_counter() - epoch_start
+
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            sums = torch.tensor([loss_sum, mae, gcc_mae, acc, gcc_acc, nb_samples], dtype=torch.float64)
+            torch.distributed.all_reduce(sums)
+            loss_sum, mae, gcc_mae, acc, gcc_acc, nb_samples = sums.tolist()
+            nb_samples = int(nb_samples)
+            epoch_time = torch.tensor([epoch_time])
+            torch.distributed.all_reduce(epoch_time, op=torch.distributed.ReduceOp.MAX)
+            epoch_time = epoch_time.item()
+
+        nb = max(nb_samples, 1)
+        return logger.epoch(split, epoch, loss=loss_sum / nb, mae=mae / nb, gcc_mae=gcc_mae / nb, acc=acc / nb,
+                            gcc_acc=gcc_acc / nb, samples=nb_samples, time=epoch_time,
+                            samples_per_s=nb_samples / epoch_time if epoch_time > 0 else 0., **extra)
+
+    def forward(self, x1, x2, delays):
+        """
+        :return: loss and predicted delays in samples
+        """
+        with torch.autocast('cpu', dtype=torch.bfloat16, enabled=self.autocast):
+            y_hat = self.model(x1, x2)
+        y_hat = y_hat.float()
+        metrics.debug('y_hat.shape:', y_hat.shape)
+
+        if self.loss == 'ce':
+            shift = torch.argmax(y_hat, dim=-1) - self.max_tau
+            loss = self.loss_fn(y_hat, torch.round(delays).long())
+        else:
+            # get delay statistics for normalization when using regression loss
+            delay_mu = torch.mean(delays)
+            # 验证/测试不丢最后一个 batch，只有一个窗口时 std 没有定义
+            delay_sigma = torch.std(delays) if delays.numel() > 1 else torch.ones_like(delay_mu)
+            shift = y_hat * delay_sigma + delay_mu - self.max_tau
+            loss = self.loss_fn(y_hat, (delays - delay_mu) / delay_sigma)
+        return loss, shift
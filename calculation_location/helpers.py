@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import metrics
 
 class LabelSmoothing(nn.Module):
     """NLL loss with label smoothing.
@@ -15,7 +16,7 @@ class LabelSmoothing(nn.Module):
 
     def forward(self, x, target):
         logprobs = torch.nn.functional.log_softmax(x, dim=-1)
-        print('target.shape:', target.shape) 
+        metrics.debug('target.shape:', target.shape)
         nll_loss = -logprobs.gather(dim=-1, index=target.unsqueeze(1))
         nll_loss = nll_loss.squeeze(1)
         smooth_loss = -logprobs.mean(dim=-1)
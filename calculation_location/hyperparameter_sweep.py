@@ -0,0 +1,152 @@
+#
+# Hyperparameter sweep over cfg.py settings
+#
+# The dataset is preprocessed once here; every trial then trains in its own process of a pool,
+# reading the same memory-mapped track store, with a fixed number of torch threads.
+#
+# usage: python hyperparameter_sweep.py sweep.json [--parallel N] [--threads T]
+#
+# sweep.json:
+#   {"search": "grid",                      # or "random"
+#    "trials": 8,                           # number of random draws, ignored by grid search
+#    "seed": 0,
+#    "params": {"lr": [0.001, 0.0003], "num_channels": [64, 128], "sig_len": [1024, 2048]}}
+#
+import os
+os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
+import csv
+import json
+import time
+import argparse
+import contextlib
+import itertools
+import traceback
+import multiprocessing
+import random
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+
+import cfg
+import model_training_main_
+
+RESULT_COLUMNS = ['val_mae', 'val_acc', 'best_val_mae', 'test_mae', 'test_acc', 'train_samples_per_s', 'wall_time']
+
+
+def sweep_trials(spec):
+    """
+    Expands a sweep spec into the list of cfg overrides of every trial
+    """
+    params = spec['params']
+    names = sorted(params)
+    if spec.get('search', 'grid') == 'grid':
+        return [dict(zip(names, values)) for values in itertools.product(*(params[n] for n in names))]
+    if spec['search'] != 'random':
+        raise ValueError('Unsupported search: {}'.format(spec['search']))
+    rng = np.random.RandomState(spec.get('seed', 0))
+    return [{n: params[n][rng.randint(len(params[n]))] for n in names} for _ in range(spec['trials'])]
+
+
+def run_trial(trial_id, overrides, values, data, trial_dir, threads):
+    """
+    Trains one configuration in a pool process
+
+    :param values: cfg attributes of the parent, overrides are applied on top
+    :param data: (track_store, file_names, windows) of the trial's sig_len
+    :return: result row
+    """
+    values = dict(values)
+    values.update(overrides)
+    # 每个 trial 单独的输出目录，只用固定数量的线程，不开 DataLoader worker
+    values.update(metrics_file=os.path.join(trial_dir, 'metrics.jsonl'),
+                  checkpoint_dir=os.path.join(trial_dir, 'checkpoints'),
+                  model_file=os.path.join(trial_dir, 'model.pth'),
+                  num_workers=0, cpu_threads=threads, cpu_interop_threads=0, verbosity=0)
+    row = {'trial': trial_id}
+    row.update(overrides)
+    start = time.time()
+    os.makedirs(trial_dir, exist_ok=True)
+    try:
+        args = argparse.Namespace(resume=None, nprocs=1)
+        with open(os.path.join(trial_dir, 'train.log'), 'w') as log, contextlib.redirect_stdout(log):
+            records = model_training_main_.train(0, 1, args, values=values, data=data)
+        row.update(val_mae=records['val']['mae'], val_acc=records['val']['acc'],
+                   best_val_mae=records['best_val']['mae'], test_mae=records['test']['mae'],
+                   test_acc=records['test']['acc'], train_samples_per_s=records['train']['samples_per_s'])
+    except Exception:
+        row['error'] = traceback.format_exc().strip().splitlines()[-1]
+    row['wall_time'] = time.time() - start
+    return row
+
+
+def print_table(rows, columns):
+    cells = [[('{:.4g}'.format(row[c]) if isinstance(row.get(c), float) else str(row.get(c, ''))) for c in columns]
+             for row in rows]
+    widths = [max([len(c)] + [len(line[i]) for line in cells]) for i, c in enumerate(columns)]
+    print('  '.join(c.ljust(w) for c, w in zip(columns, widths)))
+    for line in cells:
+        print('  '.join(v.ljust(w) for v, w in zip(line, widths)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a grid or random search over cfg.py settings')
+    parser.add_argument('spec', help='json sweep spec')
+    parser.add_argument('--parallel', type=int, default=0, help='concurrent trials, 0 uses one per 4 cores')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads per trial, 0 shares the cores evenly')
+    parser.add_argument('--out', default=os.path.join('experiments', 'sweeps'), help='output folder')
+    args = parser.parse_args(argv)
+
+    with open(args.spec, 'r') as f:
+        spec = json.load(f)
+    trials = sweep_trials(spec)
+    nb_cores = os.cpu_count() or 1
+    parallel = args.parallel if args.parallel > 0 else max(1, nb_cores // 4)
+    threads = args.threads if args.threads > 0 else max(1, nb_cores // parallel)
+    sweep_dir = os.path.join(args.out, time.strftime('%Y%m%d_%H%M%S'))
+    os.makedirs(sweep_dir, exist_ok=True)
+    print('{} trials, {} in parallel with {} threads each, results in {}'.format(
+        len(trials), parallel, threads, sweep_dir))
+
+    if cfg.data_format == 'shards':
+        # 并发的 trial 会同时写同一个 shard 目录
+        print('data_format "shards" is not supported by sweeps, using "windows"')
+        cfg.data_format = 'windows'
+
+    # 只预处理一次：每个 sig_len 建一次窗口表（含 GCC 基线），所有 trial 共用同一个 memory-mapped track store
+    max_tau_gcc = model_training_main_.gcc_max_tau()
+    data = {}
+    for sig_len in sorted({trial.get('sig_len', cfg.sig_len) for trial in trials}):
+        # DataGenerator 用全局 random 打乱文件顺序；和 model_training_main_.train 一样先设种子，
+        # 每个 sig_len 和每次 sweep 的 train/val/test 文件才与单独训练时相同
+        torch.manual_seed(cfg.seed)
+        random.seed(cfg.seed)
+        np.random.seed(cfg.seed)
+        data[sig_len] = model_training_main_.load_windows(sig_len, sig_len // 2, max_tau_gcc)
+
+    values = model_training_main_.cfg_values()
+    rows = []
+    # 每个 trial 一个新进程，线程数等设置不会互相影响
+    with ProcessPoolExecutor(max_workers=parallel, mp_context=multiprocessing.get_context('spawn'),
+                             max_tasks_per_child=1) as executor:
+        futures = [executor.submit(run_trial, i, trial, values, data[trial.get('sig_len', cfg.sig_len)],
+                                   os.path.join(sweep_dir, 'trial_{:03d}'.format(i)), threads)
+                   for i, trial in enumerate(trials)]
+        for future in futures:
+            row = future.result()
+            rows.append(row)
+            print('trial {} done in {:.0f}s{}'.format(
+                row['trial'], row['wall_time'], ': ' + row['error'] if 'error' in row else ''))
+
+    columns = ['trial'] + sorted(spec['params']) + RESULT_COLUMNS
+    if any('error' in row for row in rows):
+        columns.append('error')
+    with open(os.path.join(sweep_dir, 'results.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+    print_table(sorted(rows, key=lambda row: row.get('val_mae', float('inf'))), columns)
+    return rows
+
+
+if __name__ == '__main__':
+    main()
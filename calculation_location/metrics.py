@@ -0,0 +1,147 @@
+#
+# Training instrumentation: verbosity controlled console output, per-stage wall-clock timers and
+# epoch-level metrics written to a JSONL or CSV file
+#
+import os
+import csv
+import json
+import time
+from collections import defaultdict
+
+# verbosity levels
+QUIET = 0  # nothing but errors
+EPOCH = 1  # one summary line per epoch and split
+BATCH = 2  # one line per batch
+DEBUG = 3  # tensor shapes inside the models and loops
+
+VERBOSITY = EPOCH
+
+
+def set_verbosity(level):
+    global VERBOSITY
+    VERBOSITY = level
+
+
+def log(level, *args):
+    if VERBOSITY >= level:
+        print(*args)
+
+
+def debug(*args):
+    # 在模型 forward 里调用，关闭时只多一次整数比较
+    if VERBOSITY >= DEBUG:
+        print(*args)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _StageTimer(object):
+    def __init__(self, logger, stage):
+        self.logger = logger
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.logger.add_time(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class MetricsLogger(object):
+    """
+    Accumulates per-stage wall-clock time over an epoch and writes one record per epoch and split.
+
+    Records go to `path` as JSON lines, or as CSV rows when path ends with .csv (the columns are
+    those of the first record). With timers=False, timer() and timed() hand out no-op objects.
+    """
+
+    def __init__(self, path=None, timers=True, append=False):
+        """
+        :param path: metrics file, None keeps the records on the console only
+        :param timers: measure the stages of the loops
+        :param append: add to an existing metrics file (resumed runs) instead of truncating it
+        """
+        self.path = path
+        self.timers = timers
+        self._csv_fields = None
+        self._stage_time = defaultdict(float)
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            if append and os.path.exists(path) and path.endswith('.csv'):
+                with open(path, 'r', newline='') as f:
+                    self._csv_fields = next(csv.reader(f), None)
+            elif not append:
+                open(path, 'w').close()
+
+    def timer(self, stage):
+        """
+        Context manager adding the time spent inside it to `stage`
+        """
+        if not self.timers:
+            return _NULL_TIMER
+        return _StageTimer(self, stage)
+
+    def timed(self, iterable, stage='data'):
+        """
+        Iterates over `iterable`, adding the time spent waiting for every item to `stage`
+        """
+        if not self.timers:
+            return iter(iterable)
+        return self._timed(iterable, stage)
+
+    def _timed(self, iterable, stage):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def add_time(self, stage, seconds):
+        self._stage_time[stage] += seconds
+
+    def epoch(self, split, epoch, **values):
+        """
+        Closes an epoch of `split`: joins the stage times to `values`, writes and prints the record
+
+        :return: the record
+        """
+        record = {'split': split, 'epoch': epoch}
+        record.update({k: (v.item() if hasattr(v, 'item') else v) for k, v in values.items()})
+        for stage in sorted(self._stage_time):
+            record['time_' + stage] = self._stage_time[stage]
+        self._stage_time.clear()
+        self.write(record)
+
+        if VERBOSITY >= EPOCH:
+            print('[{}] epoch {}: {}'.format(split, epoch, ', '.join(
+                '{} {}'.format(k, '{:.4g}'.format(v) if isinstance(v, float) else v)
+                for k, v in record.items() if k not in ('split', 'epoch'))))
+        return record
+
+    def write(self, record):
+        if not self.path:
+            return
+        with open(self.path, 'a', newline='') as f:
+            if not self.path.endswith('.csv'):
+                f.write(json.dumps(record) + '\n')
+                return
+            if self._csv_fields is None:
+                self._csv_fields = list(record)
+                csv.DictWriter(f, self._csv_fields).writeheader()
+            csv.DictWriter(f, self._csv_fields, extrasaction='ignore').writerow(record)
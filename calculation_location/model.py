@@ -7,14 +7,24 @@ import torch.fft
 import numpy as np
 from dnn_models import SincNet
 from torch_same_pad import get_pad
+import metrics
+
+# 只要 ±max_tau 内的 lag 时，2 * max_shift + 1 <= DFT_LAGS_PER_LOG2N * log2(n) 的情况下直接用 DFT 基矩阵
+# 乘法算这些 lag 比完整的 irfft 快（单线程 CPU 实测的交叉点）
+DFT_LAGS_PER_LOG2N = 4.5
+
 
 class GCC(nn.Module):
-    def __init__(self, max_tau=None, dim=2, filt='phat', epsilon=0.001, beta=None):
+    def __init__(self, max_tau=None, dim=2, filt='phat', epsilon=0.001, beta=None, lags='auto'):
         super().__init__()
 
         ''' GCC implementation based on Knapp and Carter,
         "The Generalized Correlation Method for Estimation of Time Delay",
-        IEEE Trans. Acoust., Speech, Signal Processing, August, 1976 '''
+        IEEE Trans. Acoust., Speech, Signal Processing, August, 1976
+
+        lags - how the lags inside +-max_tau are evaluated: 'fft' inverse transforms all n lags
+               and keeps the central ones, 'dft' computes only those lags as a matmul with a DFT
+               basis, 'auto' picks the cheaper of the two for each signal length '''
 
         print('\n\n---------------------GCC __init__ begain------------------------')
         self.max_tau = max_tau
@@ -22,15 +32,125 @@ class GCC(nn.Module):
         self.filt = filt
         self.epsilon = epsilon
         self.beta = beta
+        if lags not in ('auto', 'fft', 'dft'):
+            raise ValueError('Unsupported lag evaluation: {}'.format(lags))
+        self.lags = lags
+        self._dft_basis = {}
 
     def forward(self, x, y):
-        print('\n\n---------------------GCC forward begin------------------------')
-
         n = x.shape[-1] + y.shape[-1]
 
         # Generalized Cross Correlation Phase Transform
         X = torch.fft.rfft(x, n=n)
         Y = torch.fft.rfft(y, n=n)
+
+        max_shift = self.max_shift(n)
+        if self.dim in (2, 3) and self.dim == x.dim() and (self.beta is None or self.dim == 3):
+            # lag 在最后一维，只算 ±max_shift 以内的 lag
+            cc = self.correlate(X, Y, n, max_shift)
+        else:
+            cc = self.correlate(X, Y, n)
+            if self.dim == 2:
+                cc = torch.cat((cc[:, -max_shift:], cc[:, :max_shift+1]), dim=-1)
+            elif self.dim == 3:
+                cc = torch.cat(
+                    (cc[:, :, -max_shift:], cc[:, :, :max_shift+1]), dim=-1)
+            
+        metrics.debug('GCC——cc.shape:', cc.shape)
+        
+        return cc
+
+    def forward_pairs(self, x, pairs):
+        '''
+        Cross correlations of every mic pair of a multichannel signal in one call, each channel is
+        transformed once instead of once per pair it belongs to
+
+        :param x: (batch, n_mics, samples), or (batch, n_mics, channels, samples) for feature maps
+        :param pairs: list of (i, j) mic indices, the delay of pair (i, j) is that of forward(x[:, i], x[:, j])
+        :return: (batch, n_pairs, 2 * max_shift + 1), with a (channels * len(beta)) axis before the
+                 lags for feature maps or when beta is set, in the order forward(dim=3) gives them
+        '''
+        n = 2 * x.shape[-1]
+        batch_size = x.shape[0]
+        first = [p[0] for p in pairs]
+        second = [p[1] for p in pairs]
+
+        S = torch.fft.rfft(x, n=n)
+        if x.dim() == 3:
+            S = S.unsqueeze(2)
+        X = S[:, first].flatten(0, 1)
+        Y = S[:, second].flatten(0, 1)
+        cc = self.correlate(X, Y, n, self.max_shift(n))
+
+        cc = cc.reshape(batch_size, len(pairs), *cc.shape[1:])
+        if x.dim() == 3 and self.beta is None:
+            cc = cc.squeeze(2)
+        metrics.debug('GCC——pairs cc.shape:', cc.shape)
+
+        return cc
+
+    def max_shift(self, n):
+        max_shift = int(n / 2)
+        if self.max_tau:
+            max_shift = np.minimum(self.max_tau, int(max_shift))
+        return max_shift
+
+    def use_dft(self, n, max_shift):
+        if self.lags == 'auto':
+            return 2 * max_shift + 1 <= DFT_LAGS_PER_LOG2N * np.log2(n)
+        return self.lags == 'dft'
+
+    def dft_basis(self, n, max_shift, dtype, device):
+        '''
+        Real matrix taking the interleaved (real, imag) rfft bins of length n to the lags
+        -max_shift..max_shift of their irfft, cached per shape, dtype and device
+
+        :return: (2 * (n // 2 + 1), 2 * max_shift + 1)
+        '''
+        key = (n, int(max_shift), dtype, device)
+        if key not in self._dft_basis:
+            # 第一次调用可能在 inference_mode 下（验证、GCC 基线），缓存的必须是普通 tensor，训练时才能用于 backward
+            with torch.inference_mode(False):
+                k = torch.arange(n // 2 + 1, dtype=torch.int64).unsqueeze(1)
+                m = torch.arange(-max_shift, max_shift + 1, dtype=torch.int64).unsqueeze(0)
+                # 整数取模后再换成角度，n 大时也不损失精度
+                angle = 2 * np.pi * ((k * m) % n).double() / n
+                # irfft 中除了直流和 Nyquist 频点，其余频点都出现两次（共轭对称）
+                weight = torch.full((n // 2 + 1, 1), 2., dtype=torch.float64)
+                weight[0] = 1.
+                if n % 2 == 0:
+                    weight[-1] = 1.
+                basis = torch.stack((weight * torch.cos(angle), -weight * torch.sin(angle)), dim=1) / n
+                self._dft_basis[key] = basis.reshape(-1, m.shape[1]).to(dtype=dtype, device=device)
+        return self._dft_basis[key]
+
+    def inverse(self, spectra, n, max_shift=None):
+        '''
+        irfft of length n along the last axis
+
+        :param max_shift: keep only the lags -max_shift..max_shift, in that order. None keeps all
+                          n lags in irfft order
+        '''
+        if max_shift is None:
+            return torch.fft.irfft(spectra, n)
+
+        if self.use_dft(n, max_shift):
+            real = torch.view_as_real(spectra)
+            basis = self.dft_basis(n, max_shift, real.dtype, real.device)
+            # autocast 下 matmul 会被降成 bf16，相关函数保持原精度
+            with torch.autocast(real.device.type, enabled=False):
+                return torch.matmul(real.reshape(*real.shape[:-2], -1), basis)
+
+        cc = torch.fft.irfft(spectra, n)
+        return torch.cat((cc[..., -max_shift:], cc[..., :max_shift+1]), dim=-1)
+
+    def correlate(self, X, Y, n, max_shift=None):
+        '''
+        Weighted cross correlation of two spectra
+
+        :param X, Y: rfft of length n of the two signals
+        :param max_shift: see inverse()
+        '''
         Gxy = X * torch.conj(Y)
 
         if self.filt == 'phat':
@@ -58,39 +178,29 @@ class GCC(nn.Module):
             raise ValueError('Unsupported filter function')
 
         if self.beta is not None:
-            cc = []
-            for i in range(self.beta.shape[0]):
-                cc.append(torch.fft.irfft(
-                    Gxy * torch.pow(phi, self.beta[i]), n))
-
-            cc = torch.cat(cc, dim=1)
+            # 所有 beta 的加权谱叠在 dim=1 上，一次 irfft 算完，顺序与按 beta 拼接相同
+            # 权重按 beta 逐个用标量指数计算：张量指数的 pow 在 CPU 上更慢，且末位会有差异
+            spectra = torch.stack([Gxy * torch.pow(phi, self.beta[i]) for i in range(self.beta.shape[0])], dim=1)
+            cc = self.inverse(spectra, n, max_shift).flatten(1, 2)
 
         else:
-            cc = torch.fft.irfft(Gxy * phi, n)
-
-        max_shift = int(n / 2)
-        if self.max_tau:
-            max_shift = np.minimum(self.max_tau, int(max_shift))
+            cc = self.inverse(Gxy * phi, n, max_shift)
 
-        if self.dim == 2:
-            cc = torch.cat((cc[:, -max_shift:], cc[:, :max_shift+1]), dim=-1)
-        elif self.dim == 3:
-            cc = torch.cat(
-                (cc[:, :, -max_shift:], cc[:, :, :max_shift+1]), dim=-1)
-            
-        print('GCC——cc.shape:', cc.shape) 
-        print('\n\n---------------------GCC forward end------------------------')
-        
         return cc
 
 
 class PGCCPHAT(nn.Module):
-    def __init__(self, beta=np.arange(0, 1.1, 0.1), max_tau=24, head='classifier'):
+    def __init__(self, beta=np.arange(0, 1.1, 0.1), max_tau=24, head='classifier', mlp='dense'):
         super().__init__()
 
         '''
         Implementation of CNN-Based Parametrized GCC-PHAT by Salvati et al.
         https://www.isca-speech.org/archive/pdfs/interspeech_2021/salvati21_interspeech.pdf
+
+        mlp - layers after the convolutions. 'dense' flattens the conv features into Linear
+              layers as in the paper, its first layer has 512 * 512 * (2 * max_tau - 9) weights.
+              'compact' averages the features over the beta axis and scores every lag with 1x1
+              convolutions and one short conv along the lags, its size does not depend on max_tau.
         '''
         print('\n\n---------------------PGCCPHAT calculation begain------------------------')
 
@@ -98,6 +208,9 @@ class PGCCPHAT(nn.Module):
         self.gcc = GCC(max_tau=max_tau, dim=3, filt='phat', beta=beta)
         self.head = head
         self.max_tau = max_tau
+        if mlp not in ('dense', 'compact'):
+            raise ValueError('Unsupported PGCCPHAT mlp: {}'.format(mlp))
+        self.mlp_type = mlp
 
         if head == 'regression':
             n_out = 1
@@ -114,7 +227,28 @@ class PGCCPHAT(nn.Module):
         self.bn4 = nn.BatchNorm2d(256)
         self.conv5 = nn.Conv2d(256, 512, kernel_size=(3, 3))
         self.bn5 = nn.BatchNorm2d(512)
-        
+
+        if mlp == 'compact':
+            # 五层 3x3 卷积后 lag 维少了 10 个点；最后一层 kernel 11、两边各补 10 个点，把每个 lag 的
+            # 分数放回 2 * max_tau + 1 个位置，第 i 个输出正好以第 i 个 lag 为中心
+            self.mlp = nn.Sequential(
+                nn.Conv1d(512, 128, kernel_size=1),
+                nn.BatchNorm1d(128),
+                nn.ReLU(),
+                nn.Dropout(0.2),
+                nn.Conv1d(128, 128, kernel_size=1),
+                nn.BatchNorm1d(128),
+                nn.ReLU(),
+                nn.Dropout(0.2),
+                nn.Conv1d(128, 1, kernel_size=11, padding=10)
+            )
+            if head == 'regression':
+                self.reg = nn.Sequential(
+                    nn.BatchNorm1d(2 * self.max_tau + 1),
+                    nn.LeakyReLU(0.2),
+                    nn.Linear(2 * self.max_tau + 1, 1))
+            return
+
         self.mlp = nn.Sequential(
             nn.Linear(512 * ((2 * max_tau) + 1 - 10), 512),# [512, 19968],max_tau=24;[512, 326144],max_tau=323
             nn.BatchNorm1d(512),
@@ -147,15 +281,21 @@ class PGCCPHAT(nn.Module):
 
         x = self.conv5(x)
         x = F.relu(self.bn5(x))
-        x = self.mlp(x.reshape([batch_size, -1])).squeeze()
-        print('x.shape:', x.shape) 
-        print('\n\n---------------------PGCCPHAT calculation end------------------------')
+        if self.mlp_type == 'compact':
+            # 在 beta 维上平均，(batch, 512, lags - 10)
+            x = self.mlp(x.mean(dim=2)).reshape([batch_size, -1])
+            if self.head == 'regression':
+                x = self.reg(x)
+            x = x.squeeze()
+        else:
+            x = self.mlp(x.reshape([batch_size, -1])).squeeze()
+        metrics.debug('PGCCPHAT x.shape:', x.shape)
 
         return x
     
 class NGCCPHAT(nn.Module):
     def __init__(self, max_tau=42, head='classifier', use_sinc=True,
-                                        sig_len=2048, num_channels=128, fs=20000):
+                                        sig_len=2048, num_channels=128, fs=20000, sinc_layer='fast'):
         super().__init__()
         print('\n\n---------------------NGCCPHAT calculation begain------------------------')
         '''
@@ -168,10 +308,13 @@ class NGCCPHAT(nn.Module):
         sig_len - length of input signal
         n_channel - number of gcc correlation channels to use
         fs - sampling frequency
+        sinc_layer - sinc filter layer of the backbone, 'fast' (SincConv_fast) or 'legacy' (sinc_conv)
         '''
 
         self.max_tau = max_tau
         self.head = head
+        self.sig_len = sig_len
+        self.fs = fs
 
         sincnet_params = {'input_dim': sig_len,
                           'fs': fs,
@@ -185,6 +328,7 @@ class NGCCPHAT(nn.Module):
                           'cnn_act': ['leaky_relu', 'leaky_relu', 'leaky_relu', 'linear'],
                           'cnn_drop': [0.0, 0.0, 0.0, 0.0],
                           'use_sinc': use_sinc,
+                          'sinc_layer': sinc_layer,
                           }
 
         self.backbone = SincNet(sincnet_params)
@@ -216,8 +360,51 @@ class NGCCPHAT(nn.Module):
         y2 = self.backbone(x2)
 
         cc = self.gcc(y1, y2)
-        print('cc.shape:', cc.shape) 
+        metrics.debug('NGCCPHAT gcc cc.shape:', cc.shape)
+
+        cc = self.decode(cc).reshape([batch_size, -1])
+        if self.head == 'regression':
+            cc = self.reg(cc).squeeze()
+        metrics.debug('NGCCPHAT cc.shape:', cc.shape)
+
+        return cc
 
+    def forward_pairs(self, x, pairs):
+        '''
+        Delay logits of every mic pair of a multichannel frame. The backbone runs once per
+        microphone in a single batched call and all pair GCCs are formed from the shared features,
+        instead of every microphone going through the backbone once per pair.
+
+        In eval mode the result equals forward(x[:, i], x[:, j]) for each pair (i, j). In training
+        mode the backbone's batch norm statistics are taken over all microphones together.
+
+        :param x: (batch, n_mics, samples)
+        :param pairs: list of (i, j) mic indices
+        :return: (batch, n_pairs, 2 * max_tau + 1), or (batch, n_pairs) with the regression head
+        '''
+        batch_size, n_mics = x.shape[:2]
+
+        y = self.backbone(x.reshape(batch_size * n_mics, -1))
+        y = y.reshape(batch_size, n_mics, *y.shape[1:])
+
+        cc = self.gcc.forward_pairs(y, pairs).flatten(0, 1)
+        metrics.debug('NGCCPHAT pairs gcc cc.shape:', cc.shape)
+
+        cc = self.decode(cc).reshape([batch_size * len(pairs), -1])
+        if self.head == 'regression':
+            cc = self.reg(cc)
+        cc = cc.reshape([batch_size, len(pairs), -1])
+        if self.head == 'regression':
+            cc = cc.squeeze(-1)
+        metrics.debug('NGCCPHAT pairs cc.shape:', cc.shape)
+
+        return cc
+
+    def decode(self, cc):
+        '''
+        Conv layers from the GCC of the backbone features, (batch, channels, lags), to one
+        correlation per lag, (batch, 1, lags)
+        '''
         for k, layer in enumerate(self.mlp):
             s = cc.shape[2]
             padding = get_pad(
@@ -229,10 +416,4 @@ class NGCCPHAT(nn.Module):
         padding = get_pad(
             size=s, kernel_size=self.final_kernel, stride=1, dilation=1)
         cc = F.pad(cc, pad=padding, mode='constant')
-        cc = self.final_conv(cc).reshape([batch_size, -1])
-        if self.head == 'regression':
-            cc = self.reg(cc).squeeze()
-        print('cc.shape:', cc.shape) 
-        print('\n\n---------------------NGCCPHAT  end------------------------')
-
-        return cc
\ No newline at end of file
+        return self.final_conv(cc)
\ No newline at end of file
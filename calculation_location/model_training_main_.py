@@ -2,398 +2,341 @@
 
 import os
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
+import sys
+import argparse
+import inspect
+import functools
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from tqdm import tqdm
 import numpy as np
 import random
-from sklearn.model_selection import train_test_split
 from torchinfo import summary
 from model import NGCCPHAT, PGCCPHAT, GCC
 
 import cfg
 import matplotlib.pyplot as plot
 import cls_data_generator
+import shards
+import metrics
+import engine
+import augmentation
+import checkpoint
 from helpers import LabelSmoothing
 plot.switch_backend('agg')
 
-torch.autograd.set_detect_anomaly(True)
-
-# for reproducibility
-torch.manual_seed(cfg.seed)
-random.seed(cfg.seed)
-np.random.seed(cfg.seed)
-
-# calculate the max_delay for gcc
-max_tau_gcc = int(np.floor(
-    max(np.linalg.norm(cfg.mic_locs_train[:, 0] - cfg.mic_locs_train[:, 1]), 
-    np.linalg.norm(cfg.mic_locs_train[:, 0] - cfg.mic_locs_train[:, 1]), 
-    np.linalg.norm(cfg.mic_locs_train[:, 0] - cfg.mic_locs_train[:, 1])) * cfg.mic_fs / cfg.c))
-print('max_tau_gcc:',max_tau_gcc)
-
-# training parameters
-max_tau = max_tau_gcc # cfg.max_delay# cfg.max_delay
-fs = cfg.mic_fs
-sig_len = cfg.sig_len
-
-epochs = cfg.epochs
-# DataLoader参数
-batch_size = cfg.batch_size
-lr = cfg.lr
-wd = cfg.wd
-audio_length = cfg.mic_fs * cfg.audio_length_s
-label_smooth = cfg.ls
-
-# Training setup
-all_splits = [1, 2]
-
-# 对所有文件夹进行循环处理。
-print('\n\n---------------------------------------------------------------------------------------------------')
-print('----------------------------------      preparing dataset   ------------------------------------------')
-print('-------------------------------------------------------------------------------------------   --------')
-
-# ------------------------------- Load train and validation data  -------------------------------
-print('Loading all dataset:')
-data_gen_all =cls_data_generator.DataGenerator(cfg=cfg, split=all_splits)
-tensors1, tensors2, targets =data_gen_all.generate()
-samples1 = tensors1.view(-1).numpy() 
-samples2 = tensors2.view(-1).numpy()
-labels = targets.view(-1).numpy()
-
-# 合并 samples1 和 samples2
-data = np.column_stack((samples1, samples2))
-print('\n\n---------------------------------------------------------------------------------------------------')
-
-train_data, temp_data, train_labels, temp_labels = train_test_split(data, labels, test_size=0.3, random_state=42)
-val_data, test_data, val_labels, test_labels = train_test_split(temp_data, temp_labels, test_size=0.5, random_state=42)
-print(train_data)
-print('train_data.shape:', train_data.shape)
-print(train_labels)
-print('train_labels.shape:', train_labels.shape) 
-print('\n---------------------------------------------------------------------------------------------------')
-
-# 自定义数据集类，实现overlapping windows
-class SequenceDataset(object):
-    def __init__(self, data, labels, window_size, stride):
-        self.data = data
-        self.labels = labels
-        self.window_size = window_size
-        self.stride = stride
-
-    def __len__(self):
-        return int(max(1, (len(self.data) - self.window_size) // self.stride))#+ 1
-
-    def __getitem__(self, idx):
-        start = int(idx * self.stride)
-        end = int(start + self.window_size)
-        data_slice = self.data[start:end]
-        label_slice = self.labels[start:end]
-        return data_slice, label_slice
-
-# 定义窗口大小和步长
-window_size = sig_len
-stride = window_size/2
-
-# 创建数据集
-train_set = SequenceDataset(train_data, train_labels, window_size, stride)
-val_set = SequenceDataset(val_data, val_labels, window_size, stride)
-test_set = SequenceDataset(test_data, test_labels, window_size, stride)
-
-# use GPU if available, else CPU
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-print("Using device: " + str(device))
-if device == "cuda":
-    num_workers = 1
-    pin_memory = True
-else:
-    num_workers = 0
-    pin_memory = False
-
-# load model
-if cfg.model == 'NGCCPHAT':
-    use_sinc = True if not cfg.no_sinc else False
-    model = NGCCPHAT(max_tau, cfg.head, use_sinc,
-                     sig_len, cfg.num_channels, fs)
-elif cfg.model == 'PGCCPHAT':
-    model = PGCCPHAT(max_tau=max_tau_gcc, head=cfg.head)
-else:
-    raise Exception("Please specify a valid model")
-
-model = model.to(device)
-model.eval()
-summary(model, [(1, 1, sig_len), (1, 1, sig_len)])
-
-gcc = GCC(max_tau=max_tau_gcc)
-
-optimizer = optim.AdamW(model.parameters(), lr=lr, weight_decay=wd)
-scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, epochs)
-
-if cfg.loss == 'ce':
-    loss_fn = LabelSmoothing(label_smooth)
-elif cfg.loss == 'mse':
-    loss_fn = nn.MSELoss()
-else:
-    raise Exception("Please specify a valid loss function")
-print('Using loss function: ' + str(loss_fn))
-
-# ------------------------------- Load data and start training  -------------------------------
-# torch.utils.data.DataLoader是PyTorch中用于加载数据的一个迭代器工具。
-# 它可以方便地从一个数据集(Dataset)中按批次(batch)加载数据。
-train_loader = torch.utils.data.DataLoader(
-    train_set,
-    batch_size=batch_size,
-    shuffle=True,
-    num_workers=num_workers,
-    pin_memory=pin_memory,
-    drop_last=True,
-)
-
-val_loader = torch.utils.data.DataLoader(
-    val_set,
-    batch_size=batch_size,
-    shuffle=False,
-    num_workers=num_workers,
-    pin_memory=pin_memory,
-    drop_last=True,
-)
-
-test_loader = torch.utils.data.DataLoader(
-    test_set,
-    batch_size=batch_size,
-    shuffle=False,
-    num_workers=num_workers,
-    pin_memory=pin_memory,
-    drop_last=True,
-)
-print('\n\n------------------------------------------------------------------------------------------')
-
-print('\n\n----------------------------start training------------------------------------------------')
-for e in range(epochs):
-    mae = 0
-    gcc_mae = 0
-    acc = 0
-    gcc_acc = 0
-    train_loss = 0
-    logs = {}
-    model.train()
-    pbar_update = batch_size
-    with tqdm(total=len(train_loader.dataset)) as pbar:
-        for batch_idx, (data, target) in enumerate(train_loader):
-            print('\nbatch_idx:', batch_idx)
-            print('\ndata.shape:', data.shape)
-            # 分离并重塑 x1 和 x2
-            x1 = data[:, :, 0].unsqueeze(1)  
-            x2 = data[:, :, 1].unsqueeze(1)  
-            target = target.float().to(device)
-            delays = torch.mean(target.squeeze(),dim=-1)
-            print('\nx1.shape:', x1.shape)  # 验证形状
-            print('\nx2.shape:', x2.shape)  # 验证形状
-            print('\ndelays.shape:', delays.shape)  # 验证形状
-            print('\ndelays:', delays)
-            bs = x1.shape[0]
-            print('bs:', bs)
-            # get delay statistics for normalization when using regression loss
-            if cfg.loss == "mse":
-                delay_mu = torch.mean(delays) 
-                delay_sigma = torch.std(delays) 
-                print('\ndelay_mu:', delay_mu) 
-                print('\ndelay_mu.shape:', delay_mu.shape) 
-                print('\ndelay_sigma:', delay_sigma) 
-                print('\ndelay_sigma.shape:', delay_sigma.shape) 
-
-            print('开始计算GCC') 
-            
-            cc = gcc(x1.squeeze(), x2.squeeze())
-            print('\nx1.squeeze().shape:', x1.squeeze().shape)  # 验证形状
-            shift_gcc = torch.argmax(cc, dim=-1) - max_tau_gcc
-            print('shift_gcc.shape:', shift_gcc.shape) 
-
-            print('开始计算model') 
-
-            if cfg.loss == 'ce':
-                delays_loss = torch.round(delays).type(torch.LongTensor)
-                print('\n delays_loss.shape:', delays_loss.shape) 
-                y_hat = model(x1, x2)
-                print('\n y_hat.shape:', y_hat.shape) 
-                shift = torch.argmax(y_hat, dim=-1) - max_tau
-                print('\n shift.shape:', shift.shape) 
-            else:
-                delays_loss = (delays - delay_mu) / delay_sigma
-                print('\n delays_loss.shape:', delays_loss.shape) 
-                y_hat = model(x1, x2)
-                print('\n y_hat.shape:', y_hat.shape) 
-                shift = y_hat * delay_sigma + delay_mu - max_tau
-                print('\n shift.shape:', shift.shape) 
-
-            gt = delays - max_tau
-            print('\n gt.shape:', gt.shape) 
-            mae += torch.sum(torch.abs(shift-gt))
-            gcc_mae += torch.sum(torch.abs(shift_gcc-gt))
-
-            acc += torch.sum(torch.abs(shift-gt) < cfg.t)
-            gcc_acc += torch.sum(torch.abs(shift_gcc-gt) < cfg.t)
-
-            optimizer.zero_grad()
-            print('y_hat.shape:', y_hat.shape)
-            print('delays_loss.shape:', delays_loss.shape)
-            loss = loss_fn(y_hat, delays_loss.to(device))
-            loss.backward()
-            optimizer.step()
-            train_loss += loss.detach().item() * bs
-            pbar.update(pbar_update)
-
-    train_loss = train_loss / len(train_loader.dataset)
-    print(f"Epoch {e+1}, Train Loss: {train_loss:.4f}")
-    mae = mae / len(train_loader.dataset)
-    gcc_mae = gcc_mae / len(train_loader.dataset)
-    acc = acc / len(train_loader.dataset)
-    gcc_acc = gcc_acc / len(train_loader.dataset)
-
-    scheduler.step()
-    torch.cuda.empty_cache()
-
-    print('\n\n------------------------ start Validation --------------------------------------------')
-    # Validation
+def configure_cpu(world_size=1):
+    """
+    CPU throughput profile: splits the cores between DataLoader workers and torch's compute threads
+
+    Has to run before torch starts any parallel work, torch.set_num_interop_threads fails afterwards.
+
+    :param world_size: number of training processes sharing the machine's cores
+    :return: number of DataLoader workers
+    """
+    nb_cores = max(1, (os.cpu_count() or 1) // world_size)
+    num_workers = cfg.num_workers if cfg.num_workers >= 0 else max(1, nb_cores // 4)
+    num_threads = cfg.cpu_threads if cfg.cpu_threads > 0 else max(1, nb_cores - num_workers)
+    torch.set_num_threads(num_threads)
+    if cfg.cpu_interop_threads > 0:
+        torch.set_num_interop_threads(cfg.cpu_interop_threads)
+    print('CPU profile: {} cores, {} DataLoader workers, {} intra-op threads, {} inter-op threads'.format(
+        nb_cores, num_workers, torch.get_num_threads(), torch.get_num_interop_threads()))
+    return num_workers
+
+def load_windows(window_size, stride, max_tau_gcc, read_only=False):
+    """
+    Brings the preprocessed dataset up to date and builds its window table
+
+    :param read_only: use the dataset and GCC baseline cache as another process left them, see
+                      cls_data_generator.DataGenerator
+    :return: track store, file names and window table, with the cached GCC-PHAT baseline as its
+             gcc_shift column
+    """
+    # Training setup
+    all_splits = [1, 2]
+
+    # 对所有文件夹进行循环处理。
+    print('\n\n---------------------------------------------------------------------------------------------------')
+    print('----------------------------------      preparing dataset   ------------------------------------------')
+    print('-------------------------------------------------------------------------------------------   --------')
+
+    # ------------------------------- Load train and validation data  -------------------------------
+    print('Loading all dataset:')
+    data_gen_all =cls_data_generator.DataGenerator(cfg=cfg, split=all_splits, read_only=read_only)
+    print('\n\n---------------------------------------------------------------------------------------------------')
+
+    # 每个窗口一行标签：窗口内的平均 delay，不再为每个采样点保存 target
+    windows = data_gen_all.window_labels(window_size, stride)
+    track_store, file_names = data_gen_all.track_store, data_gen_all.file_names
+
+    # GCC-PHAT 基线与模型无关，每个窗口只算一次，作为窗口表的一列保存并缓存到磁盘
+    gcc = GCC(max_tau=max_tau_gcc)
+    baseline_file = os.path.join(cfg.dataset_dir, '{}_dev_gcc_{}_{}.npz'.format(cfg.dataset, window_size, stride))
+    baseline_fingerprint = shards.windows_fingerprint(file_names, windows, window_size) + track_store.signature()
+    gcc_shift = engine.window_gcc_shifts(
+        cls_data_generator.WindowDataset(track_store, file_names, windows, window_size), gcc, max_tau_gcc,
+        cache_file=baseline_file, fingerprint=baseline_fingerprint)
+    return track_store, file_names, cls_data_generator.with_field(windows, 'gcc_shift', gcc_shift)
+
+def gcc_max_tau():
+    # calculate the max_delay for gcc
+    return int(np.floor(
+        max(np.linalg.norm(cfg.mic_locs_train[:, 0] - cfg.mic_locs_train[:, 1]), 
+        np.linalg.norm(cfg.mic_locs_train[:, 0] - cfg.mic_locs_train[:, 1]), 
+        np.linalg.norm(cfg.mic_locs_train[:, 0] - cfg.mic_locs_train[:, 1])) * cfg.mic_fs / cfg.c))
+
+def cfg_values():
+    # 子进程会重新 import cfg，把当前进程里（可能被修改过的）配置一起传过去
+    return {k: v for k, v in vars(cfg).items() if not k.startswith('_') and not inspect.ismodule(v)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Train NGCCPHAT/PGCCPHAT on the windowed dataset')
+    parser.add_argument('--resume', nargs='?', const='latest', default=None,
+                        help="continue from a checkpoint in cfg.checkpoint_dir: 'latest' (default), 'best' or a path")
+    parser.add_argument('--nprocs', type=int, default=1,
+                        help='number of local processes training data-parallel over gloo')
+    args = parser.parse_args(argv)
+
+    if args.nprocs > 1:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', str(cfg.dist_port))
+        torch.multiprocessing.spawn(train, args=(args.nprocs, args, cfg_values()), nprocs=args.nprocs)
+    elif int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        # started by torchrun, which also sets MASTER_ADDR/MASTER_PORT, e.g. across several nodes
+        train(int(os.environ['RANK']), int(os.environ['WORLD_SIZE']), args)
+    else:
+        train(0, 1, args)
+
+def train(rank, world_size, args, values=None, data=None):
+    """
+    Trains, validates and tests one model. With world_size > 1 this is one rank of a
+    DistributedDataParallel run: every rank trains on its share of the windows, rank 0 alone
+    logs and writes checkpoints and the model.
+
+    :param values: cfg attributes to set first, see cfg_values
+    :param data: (track_store, file_names, windows) from load_windows, built here if None
+    :return: dict with the last 'train' and 'val' epoch records, the 'best_val' one and the 'test' record
+    """
+    for k, v in (values or {}).items():
+        setattr(cfg, k, v)
+    distributed = world_size > 1
+    if distributed:
+        torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    if rank > 0:
+        # 只有 rank 0 输出日志
+        sys.stdout = open(os.devnull, 'w')
+
+    # use GPU if available, else CPU
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print("Using device: " + str(device))
+    if device.type == "cuda":
+        num_workers = 1
+        pin_memory = True
+    else:
+        num_workers = configure_cpu(world_size)
+        pin_memory = False
+
+    # anomaly detection slows every backward pass down, only in debug mode
+    torch.autograd.set_detect_anomaly(cfg.debug)
+    metrics.set_verbosity(cfg.verbosity if rank == 0 else metrics.QUIET)
+    logger = metrics.MetricsLogger(cfg.metrics_file if rank == 0 else None, timers=cfg.stage_timers,
+                                   append=args.resume is not None)
+
+    # for reproducibility
+    torch.manual_seed(cfg.seed)
+    random.seed(cfg.seed)
+    np.random.seed(cfg.seed)
+
+    max_tau_gcc = gcc_max_tau()
+    print('max_tau_gcc:',max_tau_gcc)
+
+    # training parameters
+    max_tau = max_tau_gcc # cfg.max_delay# cfg.max_delay
+    fs = cfg.mic_fs
+    sig_len = cfg.sig_len
+
+    epochs = cfg.epochs
+    # DataLoader参数
+    batch_size = cfg.batch_size
+    lr = cfg.lr
+    wd = cfg.wd
+    audio_length = cfg.mic_fs * cfg.audio_length_s
+    label_smooth = cfg.ls
+
+    # 定义窗口大小和步长
+    window_size = sig_len
+    stride = window_size // 2
+
+    if data is None:
+        if distributed and rank > 0:
+            # rank 0 先预处理数据、写缓存，其他进程等它完成后直接读取
+            torch.distributed.barrier()
+        track_store, file_names, windows = load_windows(window_size, stride, max_tau_gcc,
+                                                        read_only=distributed and rank > 0)
+    else:
+        track_store, file_names, windows = data
+    gcc = GCC(max_tau=max_tau_gcc)
+
+    # 按文件划分 train/val/test，同一个文件的窗口不会同时出现在两个集合里
+    train_windows, val_windows, test_windows = cls_data_generator.split_by_file(
+        windows, cfg.split_fractions, seed=cfg.seed)
+    print('train_windows.shape:', train_windows.shape)
+    print('\n---------------------------------------------------------------------------------------------------')
+
+    # 创建数据集：只保存窗口索引，数据直接从 memory-mapped track store 读取
+    train_set = cls_data_generator.WindowDataset(track_store, file_names, train_windows, window_size, max_tau)
+    val_set = cls_data_generator.WindowDataset(track_store, file_names, val_windows, window_size, max_tau)
+    test_set = cls_data_generator.WindowDataset(track_store, file_names, test_windows, window_size, max_tau)
+    if cfg.data_format == 'shards':
+        # 预先切好窗口的 shard 文件，顺序读取大文件，后台线程预取
+        shard_root = os.path.join(cfg.dataset_dir, '{}_dev_shards_{}'.format(cfg.dataset, window_size))
+        train_set = shards.shard_dataset(train_set, os.path.join(shard_root, 'train'), cfg.shard_size, cfg.seed,
+                                         shuffle_buffer=cfg.shuffle_buffer)
+        val_set = shards.shard_dataset(val_set, os.path.join(shard_root, 'val'), cfg.shard_size, cfg.seed, shuffle=False)
+        test_set = shards.shard_dataset(test_set, os.path.join(shard_root, 'test'), cfg.shard_size, cfg.seed, shuffle=False)
+    elif cfg.data_format == 'synthetic':
+        # 训练数据在 DataLoader worker 里实时合成：随机声源位置 + 分数延迟 + 噪声和增益
+        train_files = [file_names[i] for i in np.unique(train_windows['file'])]
+        if cfg.synthetic_source == 'noise':
+            train_files = []
+        train_set = augmentation.SyntheticTDOADataset(
+            cfg.mic_locs_train, cfg.xyz_min_train, cfg.xyz_max_train, window_size, fs, cfg.c,
+            cfg.synthetic_epoch_size or len(train_windows), track_store=track_store, file_names=train_files,
+            delay_offset=max_tau, max_tau=max_tau, snr_db=cfg.synthetic_snr_db, gain_db=cfg.synthetic_gain_db,
+            seed=cfg.seed)
+    if distributed and rank == 0 and data is None:
+        torch.distributed.barrier()
+
+    # load model
+    if cfg.model == 'NGCCPHAT':
+        use_sinc = True if not cfg.no_sinc else False
+        model = NGCCPHAT(max_tau, cfg.head, use_sinc,
+                         sig_len, cfg.num_channels, fs, sinc_layer=cfg.sinc_layer)
+    elif cfg.model == 'PGCCPHAT':
+        model = PGCCPHAT(max_tau=max_tau_gcc, head=cfg.head, mlp=cfg.pgcc_mlp)
+    else:
+        raise Exception("Please specify a valid model")
+
+    model = model.to(device)
     model.eval()
-    mae = 0.
-    gcc_mae = 0.
-    acc = 0.
-    gcc_acc = 0.
-    val_loss = 0.
-    with torch.no_grad():
-        for data, target in val_loader:
-            print('\nbatch_idx:', batch_idx)
-            print('\ndata.shape:', data.shape)
-            # 分离并重塑 x1 和 x2
-            x1 = data[:, :, 0].unsqueeze(1)  
-            x2 = data[:, :, 1].unsqueeze(1)  
-            target = target.float().to(device)
-            delays = torch.mean(target.squeeze(),dim=-1)
-            print('\nx1.shape:', x1.shape)  # 验证形状
-            print('\nx2.shape:', x2.shape)  # 验证形状
-            print('\ndelays.shape:', delays.shape)  # 验证形状
-            print('\ndelays:', delays)
-            bs = x1.shape[0]
-            print('bs:', bs)
-            # get delay statistics for normalization when using regression loss
-            if cfg.loss == "mse":
-                delay_mu = torch.mean(delays) 
-                delay_sigma = torch.std(delays) 
-                print('\ndelay_mu:', delay_mu) 
-                print('\ndelay_mu.shape:', delay_mu.shape) 
-                print('\ndelay_sigma:', delay_sigma) 
-                print('\ndelay_sigma.shape:', delay_sigma.shape) 
-
-            print('开始计算GCC') 
-            
-            cc = gcc(x1.squeeze(), x2.squeeze())
-            print('\nx1.squeeze().shape:', x1.squeeze().shape)  # 验证形状
-            shift_gcc = torch.argmax(cc, dim=-1) - max_tau_gcc
-            print('shift_gcc.shape:', shift_gcc.shape) 
-
-            print('开始计算model') 
-
-            if cfg.loss == 'ce':
-                delays_loss = torch.round(delays).type(torch.LongTensor)
-                print('\n delays_loss.shape:', delays_loss.shape) 
-                y_hat = model(x1, x2)
-                print('\n y_hat.shape:', y_hat.shape) 
-                shift = torch.argmax(y_hat, dim=-1) - max_tau
-                print('\n shift.shape:', shift.shape) 
-            else:
-                delays_loss = (delays - delay_mu) / delay_sigma
-                print('\n delays_loss.shape:', delays_loss.shape) 
-                y_hat = model(x1, x2)
-                print('\n y_hat.shape:', y_hat.shape) 
-                shift = y_hat * delay_sigma + delay_mu - max_tau
-                print('\n shift.shape:', shift.shape) 
-
-            gt = delays - max_tau
-            print('\n gt.shape:', gt.shape) 
-            mae += torch.sum(torch.abs(shift-gt))
-            gcc_mae += torch.sum(torch.abs(shift_gcc-gt))
-
-            acc += torch.sum(torch.abs(shift-gt) < cfg.t)
-            gcc_acc += torch.sum(torch.abs(shift_gcc-gt) < cfg.t)
-
-            loss = loss_fn(y_hat, delays_loss.to(device))
-            val_loss += loss.detach().item() * x1.shape[0]
-
-    mae = mae / len(val_loader.dataset)
-    gcc_mae = gcc_mae / len(val_loader.dataset)
-    acc = acc / len(val_loader.dataset)
-    gcc_acc = gcc_acc / len(val_loader.dataset)
-    val_loss = val_loss / len(val_loader.dataset)
-    print(f"Epoch {e+1}, Val Loss: {val_loss:.4f}")
-    torch.cuda.empty_cache()
+    summary(model, [(1, 1, sig_len), (1, 1, sig_len)])
+    net = model
+    if distributed:
+        # 每个进程一份模型，梯度在 backward 时通过 gloo all-reduce
+        net = torch.nn.parallel.DistributedDataParallel(model)
+
+    optimizer = optim.AdamW(model.parameters(), lr=lr, weight_decay=wd)
+    scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, epochs)
+
+    if cfg.loss == 'ce':
+        loss_fn = LabelSmoothing(label_smooth)
+    elif cfg.loss == 'mse':
+        loss_fn = nn.MSELoss()
+    else:
+        raise Exception("Please specify a valid loss function")
+    print('Using loss function: ' + str(loss_fn))
+
+    # ------------------------------- Load data and start training  -------------------------------
+    # torch.utils.data.DataLoader是PyTorch中用于加载数据的一个迭代器工具。
+    # 它可以方便地从一个数据集(Dataset)中按批次(batch)加载数据。
+    # 在 worker 里把窗口直接拼成 float32 batch，主线程只负责计算
+    loader_kwargs = dict(
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        drop_last=True,
+        collate_fn=functools.partial(cls_data_generator.collate_windows, dtype=torch.float32),
+    )
+    if num_workers > 0:
+        loader_kwargs.update(persistent_workers=cfg.persistent_workers, prefetch_factor=cfg.prefetch_factor)
+    # 数据顺序只由 (seed, epoch) 决定，不占用全局随机数，这样从检查点恢复时能逐位复现
+    # worker 的种子也从单独的 generator 取
+    loader_kwargs['generator'] = torch.Generator().manual_seed(cfg.seed)
+    sampler_generator = torch.Generator()
+    train_sampler = val_sampler = test_sampler = None
+    if distributed:
+        # 每个进程取窗口的一部分；流式数据集（shards/synthetic）自己按 rank 划分
+        if not isinstance(train_set, torch.utils.data.IterableDataset):
+            train_sampler = torch.utils.data.distributed.DistributedSampler(
+                train_set, world_size, rank, shuffle=True, seed=cfg.seed, drop_last=True)
+        if not isinstance(val_set, torch.utils.data.IterableDataset):
+            # 不补齐重复窗口，每个窗口只评估一次，mae 与单进程一致
+            val_sampler = cls_data_generator.ShardSampler(val_set, world_size, rank)
+            test_sampler = cls_data_generator.ShardSampler(test_set, world_size, rank)
+    elif not isinstance(train_set, torch.utils.data.IterableDataset):
+        train_sampler = torch.utils.data.RandomSampler(train_set, generator=sampler_generator)
+    train_loader = torch.utils.data.DataLoader(train_set, sampler=train_sampler, **loader_kwargs)
+    # 验证和测试用全部窗口，不丢最后一个不完整的 batch
+    eval_loader_kwargs = dict(loader_kwargs, drop_last=False)
+    val_loader = torch.utils.data.DataLoader(val_set, sampler=val_sampler, **eval_loader_kwargs)
+    test_loader = torch.utils.data.DataLoader(test_set, sampler=test_sampler, **eval_loader_kwargs)
+    print('\n\n------------------------------------------------------------------------------------------')
+
+    runner = engine.EpochRunner(net, loss_fn, gcc, max_tau, max_tau_gcc, cfg.t, device, loss=cfg.loss,
+                                logger=logger, autocast=cfg.autocast_bf16)
+
+    # 定期保存检查点（后台线程写文件），--resume 时从检查点继续
+    checkpoints = checkpoint.CheckpointManager(cfg.checkpoint_dir, keep_last=cfg.keep_last_checkpoints,
+                                               resume=args.resume is not None)
+    if args.resume is None and rank == 0:
+        # 新的训练：删掉目录里上一次训练的检查点，避免 --resume best 加载到别的训练的权重
+        checkpoints.clear()
+    start_epoch = 0
+    if args.resume is not None:
+        path = {'latest': checkpoints.latest(), 'best': checkpoints.best()}.get(args.resume, args.resume)
+        if path is None:
+            raise Exception('No checkpoint to resume from in ' + cfg.checkpoint_dir)
+        state = checkpoint.load_checkpoint(path)
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        scheduler.load_state_dict(state['scheduler'])
+        checkpoint.set_rng_state(state['rng'])
+        start_epoch = state['cursor']['epoch']
+        print('Resuming from {}, epoch {}'.format(path, start_epoch + 1))
+
+    records = {'train': None, 'val': None, 'best_val': None, 'test': None}
+    print('\n\n----------------------------start training------------------------------------------------')
+    for e in range(start_epoch, epochs):
+        sampler_generator.manual_seed(cfg.seed + e)
+        if isinstance(train_sampler, torch.utils.data.distributed.DistributedSampler):
+            train_sampler.set_epoch(e)
+        if hasattr(train_set, 'set_epoch'):
+            train_set.set_epoch(e)
+        train_record = runner.run(train_loader, 'train', e + 1, optimizer=optimizer, lr=scheduler.get_last_lr()[0])
+        scheduler.step()
+        torch.cuda.empty_cache()
+
+        # Validation
+        val_record = runner.run(val_loader, 'val', e + 1)
+        torch.cuda.empty_cache()
+        records['train'], records['val'] = train_record, val_record
+        if records['best_val'] is None or val_record['mae'] < records['best_val']['mae']:
+            records['best_val'] = val_record
+
+        if rank == 0 and ((e + 1) % cfg.checkpoint_every == 0 or e + 1 == epochs):
+            checkpoints.save(e + 1, {
+                'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(),
+                'rng': checkpoint.rng_state(),
+                'cursor': {'epoch': e + 1},  # 下一个 epoch 从这里开始，数据顺序由 (seed, epoch) 决定
+            }, score=val_record['mae'])
+    checkpoints.close()
     
-# ------------------------------- training done, save the model  -------------------------------
-# Save the model
-torch.save(model.state_dict(), 'experiments/NGCC/model.pth')
-print('\n\n------------------------------------------------------------------------------------------')
-
-# 在测试集上评估模型
-model.eval()
-test_loss = 0
-with torch.no_grad():
-    for data, target in test_loader:
-        print('\nbatch_idx:', batch_idx)
-        print('\ndata.shape:', data.shape)
-        # 分离并重塑 x1 和 x2
-        x1 = data[:, :, 0].unsqueeze(1)  
-        x2 = data[:, :, 1].unsqueeze(1)  
-        target = target.float().to(device)
-        delays = torch.mean(target.squeeze(),dim=-1)
-        print('\nx1.shape:', x1.shape)  # 验证形状
-        print('\nx2.shape:', x2.shape)  # 验证形状
-        print('\ndelays.shape:', delays.shape)  # 验证形状
-        print('\ndelays:', delays)
-        bs = x1.shape[0]
-        print('bs:', bs)
-        # get delay statistics for normalization when using regression loss
-        if cfg.loss == "mse":
-            delay_mu = torch.mean(delays) 
-            delay_sigma = torch.std(delays) 
-            print('\ndelay_mu:', delay_mu) 
-            print('\ndelay_mu.shape:', delay_mu.shape) 
-            print('\ndelay_sigma:', delay_sigma) 
-            print('\ndelay_sigma.shape:', delay_sigma.shape) 
-
-        print('开始计算GCC') 
-        
-        cc = gcc(x1.squeeze(), x2.squeeze())
-        print('\nx1.squeeze().shape:', x1.squeeze().shape)  # 验证形状
-        shift_gcc = torch.argmax(cc, dim=-1) - max_tau_gcc
-        print('shift_gcc.shape:', shift_gcc.shape) 
-
-        print('开始计算model') 
-
-        if cfg.loss == 'ce':
-            delays_loss = torch.round(delays).type(torch.LongTensor)
-            print('\n delays_loss.shape:', delays_loss.shape) 
-            y_hat = model(x1, x2)
-            print('\n y_hat.shape:', y_hat.shape) 
-            shift = torch.argmax(y_hat, dim=-1) - max_tau
-            print('\n shift.shape:', shift.shape) 
-        else:
-            delays_loss = (delays - delay_mu) / delay_sigma
-            print('\n delays_loss.shape:', delays_loss.shape) 
-            y_hat = model(x1, x2)
-            print('\n y_hat.shape:', y_hat.shape) 
-            shift = y_hat * delay_sigma + delay_mu - max_tau
-            print('\n shift.shape:', shift.shape) 
-
-        gt = delays - max_tau
-        print('\n gt.shape:', gt.shape) 
-        mae += torch.sum(torch.abs(shift-gt))
-        gcc_mae += torch.sum(torch.abs(shift_gcc-gt))
-
-        acc += torch.sum(torch.abs(shift-gt) < cfg.t)
-        gcc_acc += torch.sum(torch.abs(shift_gcc-gt) < cfg.t)
-
-        loss = loss_fn(y_hat, delays_loss.to(device))
-        test_loss += loss.detach().item() * x1.shape[0]
-
-test_loss /= len(test_loader.dataset)
-print(f"Test Loss: {test_loss:.4f}")
\ No newline at end of file
+    # ------------------------------- training done, save the model  -------------------------------
+    # Save the model
+    if rank == 0:
+        if os.path.dirname(cfg.model_file):
+            os.makedirs(os.path.dirname(cfg.model_file), exist_ok=True)
+        torch.save(model.state_dict(), cfg.model_file)
+    print('\n\n------------------------------------------------------------------------------------------')
+
+    # 在测试集上评估模型
+    records['test'] = runner.run(test_loader, 'test', epochs)
+    if distributed:
+        torch.distributed.destroy_process_group()
+    return records
+
+if __name__ == '__main__':
+    main()
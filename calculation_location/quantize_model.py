@@ -0,0 +1,222 @@
+#
+# Post-training int8 quantization of a trained NGCCPHAT for CPU inference
+#
+# static: batch norms are folded into the convs before them, then the backbone convs after the sinc
+#         layer, the mlp convs, final_conv and the regression Linear run as int8 kernels. Their
+#         activation ranges are calibrated on training windows read through cls_data_generator.
+#         The sinc layer, the GCC and the batch norm after the sinc layer stay float32.
+# dynamic: int8 weights with activations quantized on the fly. torch has dynamic kernels for
+#          nn.Linear only, so this covers the regression head alone and leaves a classifier unchanged.
+#
+# Both versions are evaluated against the float32 model on the test split (mae, acc under cfg.t and
+# forward throughput), and the int8 model is written next to the float32 one.
+#
+# usage: python quantize_model.py [model.pth] [--mode static|dynamic] [--calib N] [--out model_int8.pth]
+#
+import os
+os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
+import copy
+import random
+import argparse
+import functools
+import warnings
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+import cfg
+import cls_data_generator
+import engine
+import metrics
+import model_training_main_
+from model import NGCCPHAT, GCC
+from helpers import LabelSmoothing
+
+# torch.ao.quantization 的 eager 模式接口已标记为 deprecated，但仍是唯一不需要 trace 整个模型的方式
+warnings.filterwarnings('ignore', category=DeprecationWarning, module='torch.ao.quantization')
+from torch.ao.quantization import QuantWrapper, get_default_qconfig, default_dynamic_qconfig, prepare, convert, \
+    quantize_dynamic
+
+QUANTIZE_MODES = ('static', 'dynamic')
+
+
+def quantized_engine():
+    """
+    Selects the best int8 CPU backend of this torch build
+    """
+    for name in ('x86', 'fbgemm', 'qnnpack'):
+        if name in torch.backends.quantized.supported_engines:
+            torch.backends.quantized.engine = name
+            return name
+    raise RuntimeError('This torch build has no quantized CPU engine')
+
+
+def model_kwargs():
+    """
+    NGCCPHAT arguments of the model trained with the current cfg, as in model_training_main_.train
+    """
+    return dict(max_tau=model_training_main_.gcc_max_tau(), head=cfg.head, use_sinc=not cfg.no_sinc,
+                sig_len=cfg.sig_len, num_channels=cfg.num_channels, fs=cfg.mic_fs, sinc_layer=cfg.sinc_layer)
+
+
+def prepare_static(model, qconfig):
+    """
+    Folds the batch norms and wraps every int8 layer of an eval-mode NGCCPHAT between a
+    QuantStub and a DeQuantStub, in place. The layers in between keep float32 tensors.
+
+    :return: the model, ready for calibration
+    """
+    backbone = model.backbone
+    for i in range(1, backbone.N_cnn_lay):
+        conv = backbone.conv[i]
+        if backbone.cnn_use_batchnorm[i] and backbone.cnn_max_pool_len[i] == 1:
+            # max_pool1d 的核长为 1 时 bn 紧跟在卷积后面，可以合并进卷积
+            conv = fuse_conv_bn_eval(conv, backbone.bn[i])
+            backbone.bn[i] = nn.Identity()
+        backbone.conv[i] = QuantWrapper(conv)
+        backbone.conv[i].qconfig = qconfig
+
+    for layer in model.mlp:
+        layer[0] = QuantWrapper(fuse_conv_bn_eval(layer[0], layer[1]))
+        layer[0].qconfig = qconfig
+        layer[1] = nn.Identity()
+    model.final_conv = QuantWrapper(model.final_conv)
+    model.final_conv.qconfig = qconfig
+    if model.head == 'regression':
+        model.reg[2] = QuantWrapper(model.reg[2])
+        model.reg[2].qconfig = qconfig
+    return prepare(model)
+
+
+def quantize(model, mode='static', calib_batches=()):
+    """
+    int8 copy of a trained NGCCPHAT
+
+    :param model: float32 NGCCPHAT, left unchanged
+    :param mode: 'static' or 'dynamic'
+    :param calib_batches: iterable of (x1, x2) float32 batches of shape (batch, 1, sig_len), used by
+                          the static mode to record the activation ranges
+    :return: the quantized model in eval mode, runs on the CPU only
+    """
+    if mode not in QUANTIZE_MODES:
+        raise ValueError('Unsupported quantization mode: {}'.format(mode))
+    quantized_engine()
+    model = copy.deepcopy(model).cpu().eval()
+    if mode == 'dynamic':
+        return quantize_dynamic(model, {nn.Linear: default_dynamic_qconfig}, dtype=torch.qint8)
+
+    model = prepare_static(model, get_default_qconfig(torch.backends.quantized.engine))
+    with torch.inference_mode():
+        for x1, x2 in calib_batches:
+            model(x1, x2)
+    return convert(model).eval()
+
+
+def save_quantized(model, path, kwargs, mode):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.save({'kwargs': kwargs, 'mode': mode, 'engine': torch.backends.quantized.engine,
+                'state_dict': model.state_dict()}, path)
+
+
+def load_quantized(path):
+    """
+    Loads a model written by this tool. The int8 layers are rebuilt from the NGCCPHAT arguments
+    stored with it and take their weights, scales and zero points from the file.
+
+    :return: quantized NGCCPHAT in eval mode
+    """
+    saved = torch.load(path, map_location='cpu')
+    quantized_engine()
+    if saved['engine'] in torch.backends.quantized.supported_engines:
+        torch.backends.quantized.engine = saved['engine']
+    model = NGCCPHAT(**saved['kwargs']).eval()
+    if saved['mode'] == 'dynamic':
+        model = quantize_dynamic(model, {nn.Linear: default_dynamic_qconfig}, dtype=torch.qint8)
+    else:
+        # 不做校准，只建出同样结构的 int8 层，量化参数从文件读取
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            model = convert(prepare_static(model, get_default_qconfig(torch.backends.quantized.engine)))
+    model.load_state_dict(saved['state_dict'])
+    return model.eval()
+
+
+def calibration_batches(dataset, nb_windows, batch_size, seed):
+    """
+    Random windows of `dataset` in batches of the model's input shape
+    """
+    rng = np.random.RandomState(seed)
+    indices = rng.choice(len(dataset), min(nb_windows, len(dataset)), replace=False)
+    for start in range(0, len(indices), batch_size):
+        items = [dataset[i] for i in indices[start:start + batch_size]]
+        x1 = torch.from_numpy(np.stack([item[0] for item in items])).float().unsqueeze(1)
+        x2 = torch.from_numpy(np.stack([item[1] for item in items])).float().unsqueeze(1)
+        yield x1, x2
+
+
+def evaluate(model, loader, gcc, max_tau, max_tau_gcc, split):
+    """
+    :return: epoch record of `model` on `loader`, with the forward throughput as forward_samples_per_s
+    """
+    loss_fn = LabelSmoothing(cfg.ls) if cfg.loss == 'ce' else nn.MSELoss()
+    logger = metrics.MetricsLogger(timers=True)
+    runner = engine.EpochRunner(model, loss_fn, gcc, max_tau, max_tau_gcc, cfg.t, torch.device('cpu'),
+                                loss=cfg.loss, logger=logger)
+    record = runner.run(loader, split, 0)
+    record['forward_samples_per_s'] = record['samples'] / record['time_forward'] if record['time_forward'] > 0 else 0.
+    return record
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Quantize a trained NGCCPHAT to int8 for CPU inference')
+    parser.add_argument('model', nargs='?', default=cfg.model_file, help='float32 state dict (default cfg.model_file)')
+    parser.add_argument('--mode', choices=QUANTIZE_MODES, default='static')
+    parser.add_argument('--calib', type=int, default=512, help='training windows used for static calibration')
+    parser.add_argument('--out', default=None, help='quantized model file, default <model>_int8.pth')
+    args = parser.parse_args(argv)
+    out = args.out or os.path.splitext(args.model)[0] + '_int8.pth'
+
+    if cfg.model != 'NGCCPHAT':
+        raise Exception('Only NGCCPHAT models can be quantized')
+    model_training_main_.configure_cpu()
+    kwargs = model_kwargs()
+    max_tau = max_tau_gcc = kwargs['max_tau']
+    model = NGCCPHAT(**kwargs)
+    model.load_state_dict(torch.load(args.model, map_location='cpu'))
+    model.eval()
+
+    # 与训练时相同的窗口和按文件划分，校准只用训练集，评估用测试集
+    # DataGenerator 用全局 random 打乱文件顺序，种子要和 model_training_main_.train 一样，划分才一致
+    torch.manual_seed(cfg.seed)
+    random.seed(cfg.seed)
+    np.random.seed(cfg.seed)
+    window_size = cfg.sig_len
+    track_store, file_names, windows = model_training_main_.load_windows(window_size, window_size // 2, max_tau_gcc)
+    train_windows, _, test_windows = cls_data_generator.split_by_file(windows, cfg.split_fractions, seed=cfg.seed)
+    train_set = cls_data_generator.WindowDataset(track_store, file_names, train_windows, window_size, max_tau)
+    test_set = cls_data_generator.WindowDataset(track_store, file_names, test_windows, window_size, max_tau)
+    test_loader = torch.utils.data.DataLoader(
+        test_set, batch_size=cfg.batch_size, shuffle=False,
+        collate_fn=functools.partial(cls_data_generator.collate_windows, dtype=torch.float32))
+
+    print('Quantizing {} ({} mode, engine {})'.format(args.model, args.mode, quantized_engine()))
+    if args.mode == 'dynamic' and cfg.head != 'regression':
+        print('dynamic mode only quantizes nn.Linear layers, the classifier head has none: the model is unchanged')
+    qmodel = quantize(model, args.mode, calibration_batches(train_set, args.calib, cfg.batch_size, cfg.seed))
+    save_quantized(qmodel, out, kwargs, args.mode)
+    print('Quantized model saved: {} ({:.2f} MB, float32 {:.2f} MB)'.format(
+        out, os.path.getsize(out) / 2 ** 20, os.path.getsize(args.model) / 2 ** 20))
+
+    gcc = GCC(max_tau=max_tau_gcc)
+    fp32 = evaluate(model, test_loader, gcc, max_tau, max_tau_gcc, 'test fp32')
+    int8 = evaluate(qmodel, test_loader, gcc, max_tau, max_tau_gcc, 'test int8')
+    print('int8 - fp32: mae {:+.4f} samples, acc {:+.4f} (t = {:.2f} samples), forward speed-up {:.2f}x'.format(
+        int8['mae'] - fp32['mae'], int8['acc'] - fp32['acc'], cfg.t,
+        int8['forward_samples_per_s'] / max(fp32['forward_samples_per_s'], 1e-12)))
+    return fp32, int8
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+#
+# Sharded on-disk training corpus
+#
+# Windows are written once as fixed-size shards of pre-windowed (x1, x2, delay) records, so that
+# training reads a few large files sequentially instead of slicing tracks at random offsets.
+#
+import os
+import json
+import queue
+import hashlib
+import threading
+import numpy as np
+import torch
+from cls_data_generator import process_rank, worker_slot
+
+SHARD_INDEX_FILE = 'index.json'
+
+
+def record_dtype(sig_len, with_baseline=False):
+    fields = [('x1', np.int16, (sig_len,)), ('x2', np.int16, (sig_len,)), ('delay', np.float32)]
+    if with_baseline:
+        fields.append(('gcc_shift', np.float32))
+    return np.dtype(fields)
+
+
+def windows_fingerprint(file_names, windows, sig_len):
+    """
+    Identifies the windows a set of shards was written from, to know when it has to be rebuilt
+    """
+    sha1 = hashlib.sha1()
+    sha1.update(json.dumps([list(file_names), int(sig_len)]).encode())
+    sha1.update(np.ascontiguousarray(windows).tobytes())
+    return sha1.hexdigest()
+
+
+def shards_up_to_date(shard_dir, fingerprint):
+    index_path = os.path.join(shard_dir, SHARD_INDEX_FILE)
+    if not os.path.exists(index_path):
+        return False
+    with open(index_path, 'r') as f:
+        return json.load(f).get('fingerprint') == fingerprint
+
+
+def write_shards(dataset, shard_dir, shard_size=4096, seed=0, fingerprint=None):
+    """
+    Writes the windows of a WindowDataset as shards of shard_size records plus an index file
+
+    The windows are shuffled once here, so that streaming the shards in order already gives
+    well mixed batches and the reader only has to shuffle within a small buffer.
+
+    :param dataset: cls_data_generator.WindowDataset
+    :param shard_dir: output folder, existing shards in it are replaced
+    :param fingerprint: stored in the index, see windows_fingerprint
+    :return: the index dict
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    for file_name in os.listdir(shard_dir):
+        if file_name.startswith('shard_') or file_name == SHARD_INDEX_FILE:
+            os.remove(os.path.join(shard_dir, file_name))
+
+    dtype = record_dtype(dataset.sig_len, with_baseline=dataset.with_baseline)
+    order = np.random.RandomState(seed).permutation(len(dataset))
+    shards = []
+    for shard_cnt, shard_start in enumerate(range(0, len(order), shard_size)):
+        records = np.zeros(min(shard_size, len(order) - shard_start), dtype=dtype)
+        for record, idx in zip(records, order[shard_start:shard_start + shard_size]):
+            window = dataset.windows[idx]
+            x1, x2 = dataset[idx][:2]
+            record['x1'] = x1
+            record['x2'] = x2
+            record['delay'] = window['delay']
+            if dataset.with_baseline:
+                record['gcc_shift'] = window['gcc_shift']
+        file_name = 'shard_{:05d}.npy'.format(shard_cnt)
+        np.save(os.path.join(shard_dir, file_name), records)
+        shards.append({'file': file_name, 'nb_records': len(records)})
+        print('\t[{}] {}: {} records'.format(shard_dir, file_name, len(records)))
+
+    index = {'sig_len': dataset.sig_len, 'shard_size': shard_size, 'nb_records': int(len(order)),
+             'shards': shards, 'fingerprint': fingerprint}
+    with open(os.path.join(shard_dir, SHARD_INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=1)
+    return index
+
+
+def shard_dataset(dataset, shard_dir, shard_size=4096, seed=0, **kwargs):
+    """
+    ShardDataset over the windows of a WindowDataset, (re)writing the shards only when they are stale
+
+    :param kwargs: forwarded to ShardDataset
+    """
+    fingerprint = windows_fingerprint(dataset.file_names, dataset.windows, dataset.sig_len)
+    if not shards_up_to_date(shard_dir, fingerprint):
+        print('\t\twriting shards to {}'.format(shard_dir))
+        write_shards(dataset, shard_dir, shard_size=shard_size, seed=seed, fingerprint=fingerprint)
+    return ShardDataset(shard_dir, delay_offset=dataset.delay_offset, seed=seed, **kwargs)
+
+
+class ShardDataset(torch.utils.data.IterableDataset):
+    """
+    Streams the records of a shard folder written by write_shards.
+
+    Shards are read whole and in sequence by a background thread that keeps up to `prefetch`
+    of them ready, while the iterator shuffles records within a buffer of `shuffle_buffer`.
+    With several DataLoader workers, or several distributed processes, every worker streams its own
+    subset of the shards.
+    Items match those of the cls_data_generator.WindowDataset the shards were written from, so
+    collate_windows applies.
+    """
+
+    def __init__(self, shard_dir, delay_offset=0, shuffle=True, shuffle_buffer=8192, prefetch=2, seed=0):
+        super().__init__()
+        with open(os.path.join(shard_dir, SHARD_INDEX_FILE), 'r') as f:
+            self.index = json.load(f)
+        self.shard_dir = shard_dir
+        self.sig_len = self.index['sig_len']
+        self.delay_offset = delay_offset
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.prefetch = prefetch
+        self.seed = seed
+        self.epoch = 0
+        self.rank, self.world_size = process_rank()
+
+    def set_epoch(self, epoch):
+        # reshuffles shard order and buffer draws differently at every epoch, reproducibly
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.index['nb_records']
+
+    def _worker_shards(self, rng):
+        shards = [shard['file'] for shard in self.index['shards']]
+        if self.shuffle:
+            shards = [shards[i] for i in rng.permutation(len(shards))]
+        slot, nb_slots = worker_slot(self.rank, self.world_size)
+        return shards[slot::nb_slots]
+
+    def _prefetch(self, shards, ready, stop):
+        def put(item):
+            # gives up as soon as the consumer is gone, so the thread never blocks forever
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for file_name in shards:
+                if not put(np.load(os.path.join(self.shard_dir, file_name))):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    def __iter__(self):
+        # set_epoch never reaches persistent workers, each pass advances the epoch itself
+        epoch = self.epoch
+        self.epoch += 1
+        # every worker draws the same shard order, then keeps its own share of it
+        rng = np.random.RandomState(self.seed + epoch)
+        shards = self._worker_shards(rng)
+        slot, nb_slots = worker_slot(self.rank, self.world_size)
+        if nb_slots > 1:
+            rng = np.random.RandomState(self.seed + epoch + 1000 * (slot + 1))
+
+        ready = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        loader = threading.Thread(target=self._prefetch, args=(shards, ready, stop), daemon=True)
+        loader.start()
+        buffer = []
+        try:
+            while True:
+                records = ready.get()
+                if records is None:
+                    break
+                if isinstance(records, Exception):
+                    raise records
+                for record in records:
+                    if not self.shuffle:
+                        yield self._item(record)
+                        continue
+                    buffer.append(record)
+                    if len(buffer) >= self.shuffle_buffer:
+                        # swap a random record to the end and emit it
+                        i = rng.randint(len(buffer))
+                        buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                        yield self._item(buffer.pop())
+            rng.shuffle(buffer)
+            for record in buffer:
+                yield self._item(record)
+        finally:
+            stop.set()
+
+    def _item(self, record):
+        if 'gcc_shift' in record.dtype.names:
+            return record['x1'], record['x2'], np.float32(record['delay'] + self.delay_offset), record['gcc_shift']
+        return record['x1'], record['x2'], np.float32(record['delay'] + self.delay_offset)
@@ -111,6 +111,17 @@ max_tau = max_tau_gcc
 max_tau = int(max_tau)
 gcc = GCC(max_tau)
 
+# NGCC estimate next to the GCC one: int8 model written by quantize_model.py, None for GCC only
+ngcc_model_file = None  # e.g. "experiments/NGCC/model_int8.pth"
+ngcc = None
+if ngcc_model_file:
+    from quantize_model import load_quantized
+    ngcc = load_quantized(ngcc_model_file)
+    # 模型输出的 delay 以训练时的采样率为单位，录音的采样率必须一致；帧长也用训练时的窗口长度
+    if ngcc.fs != fs:
+        raise ValueError('NGCC model trained at {} Hz, recordings are at {} Hz'.format(ngcc.fs, fs))
+    sig_len = ngcc.sig_len
+
 # Loss function for optimization
 def loss(x, mic_locs, tdoas):
     pairs = [(i, j) for i in range(mic_locs.shape[1]) for j in range(i + 1, mic_locs.shape[1])]
@@ -145,19 +156,26 @@ for start_idx in range(0, min(len(y[0]), len(y[1]), len(y[2]), len(y[3])) - sig_
 
     gcc_delays = []
     mic_pairs = [(i, j) for i in range(mic_locs.shape[1]) for j in range(i + 1, mic_locs.shape[1])]
+    # All pairs in one call, every channel is transformed once
+    cc_pairs = gcc.forward_pairs(x.unsqueeze(0), mic_pairs).squeeze(0)
+    ngcc_delays = []
+    # localization needs every pair, frames with a quiet pair skip the NGCC
+    use_ngcc = ngcc is not None and not any(is_silent(x[i]) or is_silent(x[j]) for i, j in mic_pairs)
+    if use_ngcc:
+        with torch.inference_mode():
+            p_pairs = ngcc.forward_pairs(x.unsqueeze(0), mic_pairs).squeeze(0)
 
     for i, pair in enumerate(mic_pairs):
-        x1 = x[pair[0]].unsqueeze(0)
-        x2 = x[pair[1]].unsqueeze(0)
-
-        if is_silent(x1) or is_silent(x2):
+        if is_silent(x[pair[0]]) or is_silent(x[pair[1]]):
             print(f"Pair {pair}: One or both signals are too quiet, skipping GCC calculation.")
             continue
 
-        cc = gcc(x1, x2).squeeze()
+        cc = cc_pairs[i]
         cc = cc / torch.max(cc)
         shift_gcc = float(torch.argmax(cc, dim=-1)) - max_tau
         gcc_delays.append(shift_gcc)
+        if use_ngcc:
+            ngcc_delays.append(float(torch.argmax(p_pairs[i], dim=-1)) - ngcc.max_tau)
 
     if len(gcc_delays) == len(mic_pairs):
         guess = [np.mean(mic_locs[0]), np.mean(mic_locs[1])]
@@ -166,6 +184,9 @@ for start_idx in range(0, min(len(y[0]), len(y[1]), len(y[2]), len(y[3])) - sig_
 
         ax.clear()
         ax.plot(xhat_gcc[0], xhat_gcc[1], 'go', markersize=10, label='GCC estimate')
+        if len(ngcc_delays) == len(mic_pairs):
+            xhat_ngcc = minimize(loss, guess, args=(mic_locs[:2], ngcc_delays), bounds=bounds).x
+            ax.plot(xhat_ngcc[0], xhat_ngcc[1], 'mo', markersize=10, label='NGCC estimate')
         ax.plot(mic_locs[0], mic_locs[1], 'bx', markersize=10, label='Microphones')
     else:
         ax.clear()